@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" Startup benchmark: time `import cmp` in fresh interpreters and fail if
+the best time exceeds the budget, or if importing cmp pulled in one of the
+heavy dependencies which only the stages need """
+
+import sys
+import subprocess
+from optparse import OptionParser
+
+# seconds allowed for `import cmp`, without the interpreter startup
+BUDGET = 0.25
+
+# modules which importing cmp must not import
+HEAVY = ['networkx', 'nibabel', 'scipy', 'enthought', 'cfflib', 'numpy']
+
+_child = """
+import sys, time
+t = time.time()
+import cmp
+t = time.time() - t
+heavy = [m for m in %r if m in sys.modules]
+print t, ' '.join(heavy)
+"""
+
+def time_import(python):
+    """ Returns the time of `import cmp` in a fresh interpreter and the heavy
+    modules it imported """
+    out = subprocess.Popen([python, '-c', _child % HEAVY], stdout = subprocess.PIPE).communicate()[0]
+    fields = out.split()
+    return float(fields[0]), fields[1:]
+
+def main(argv):
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option('-n', '--repeat', type = 'int', default = 5,
+                      help = 'number of interpreters started [default: %default]')
+    parser.add_option('-b', '--budget', type = 'float', default = BUDGET,
+                      help = 'seconds allowed for import cmp [default: %default]')
+    parser.add_option('--python', default = sys.executable,
+                      help = 'the interpreter to benchmark [default: %default]')
+    (options, args) = parser.parse_args(argv)
+
+    times = []
+    heavy = set()
+    for i in range(options.repeat):
+        t, h = time_import(options.python)
+        times.append(t)
+        heavy.update(h)
+    print "import cmp: best %.4fs, worst %.4fs of %i runs, budget %.4fs" % \
+        (min(times), max(times), options.repeat, options.budget)
+
+    failed = False
+    if heavy:
+        print "FAIL: import cmp imported %s" % ', '.join(sorted(heavy))
+        failed = True
+    if min(times) > options.budget:
+        print "FAIL: import cmp took longer than the budget"
+        failed = True
+    return failed and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
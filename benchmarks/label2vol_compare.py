@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" Validation of the native label rasterization of the mask creation stage:
+compare the voxels of FreeSurfer .label files with the output of
+mri_label2vol --identity, voxel for voxel. Needs FreeSurfer. """
+
+import os, os.path as op
+import sys
+import shutil
+import tempfile
+import subprocess
+from glob import glob
+from optparse import OptionParser
+
+import numpy as np
+import nibabel as ni
+from cmp.stages.parcellation.maskcreation import tkr_ras2vox, label_voxels
+
+def label2vol(fname, orig, tmpdir):
+    """ Returns the mask of the label file fname rasterized by mri_label2vol """
+    out = op.join(tmpdir, 'label.nii.gz')
+    cmd = 'mri_label2vol --label "%s" --temp "%s" --o "%s" --identity' % (fname, orig, out)
+    subprocess.check_call(cmd, shell = True, stdout = open(os.devnull, 'w'))
+    return ni.load(out).get_data() == 1
+
+def main(argv):
+    parser = OptionParser(usage = "%prog [options] FREESURFER_DIR LABEL [LABEL ...]",
+                          description = "Compare the native rasterization of the labels with mri_label2vol. "
+                                        "FREESURFER_DIR is the subject directory with mri/orig.mgz and mri/aseg.nii.gz, "
+                                        "a LABEL is a .label file or a directory of them")
+    (options, args) = parser.parse_args(argv)
+    if len(args) < 2:
+        parser.error('no subject or labels given')
+
+    fs_dir = args[0]
+    orig = op.join(fs_dir, 'mri', 'orig.mgz')
+    # the geometry used by the stage
+    aseg = ni.load(op.join(fs_dir, 'mri', 'aseg.nii.gz'))
+    shape = aseg.get_shape()[:3]
+    ras2vox = tkr_ras2vox(aseg.get_affine(), shape)
+
+    fnames = []
+    for a in args[1:]:
+        if op.isdir(a):
+            fnames.extend(sorted(glob(op.join(a, '*.label'))))
+        else:
+            fnames.append(a)
+
+    tmpdir = tempfile.mkdtemp()
+    failed = 0
+    try:
+        voxels = label_voxels(fnames, ras2vox, shape)
+        for fname, idx in zip(fnames, voxels):
+            native = np.zeros(shape, dtype = np.bool_)
+            native[idx] = True
+            ref = label2vol(fname, orig, tmpdir)
+            only_native = (native & ~ref).sum()
+            only_ref = (ref & ~native).sum()
+            if only_native or only_ref:
+                failed += 1
+                print "MISMATCH %s: %i voxels, %i only native, %i only mri_label2vol" % \
+                    (fname, ref.sum(), only_native, only_ref)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print "%i of %i labels match mri_label2vol" % (len(fnames) - failed, len(fnames))
+    return failed > 0 and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
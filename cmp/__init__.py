@@ -4,49 +4,66 @@
 #
 #  This software is distributed under the open-source license Modified BSD.
 
+import sys
+import types
 from .info import __version__
 
-# PREPROCESSING
-import stages.preprocessing.organize as preprocessing
-
-# DICOM CONVERTER
-import stages.converter.dicomconverter as dicomconverter
-
-# REGISTRATION
-import stages.registration.registration as registration
-
-# FREESURFER
-import stages.segmentation.freesurfer as freesurfer
-
-# MASK: ROI_HR_th.nii / fsmask_1mm.nii CREATION
-import stages.parcellation.maskcreation as maskcreation
-
-# DIFFUSION TOOLKIT
-import stages.reconstruction.dtk as dtk
-
-# REGISTRATION: Apply registration ROI/WM --> b0
-import stages.registration.apply_registration as apply_registration
-
-# TRACTOGRAPHY
-import stages.tractography.tractography as tractography
-
-# FIBER FILTERING
-import stages.postprocessing.fiberfilter as fiberfilter
-
-# FIBER CLUSTERING
-import stages.postprocessing.fiberclustering as fiberclustering
-
-# CONNECTION MATRIX
-import stages.connectionmatrix.creatematrix as connectionmatrix
-
-# STATISTICS
-import stages.stats.fiber_statistics as fiberstatistics
-
-# CFF CONVERTER
-import stages.converter.cffconverter as cffconverter
-
-# Pipeline Status
-import pipeline.pipeline_status as pipeline_status
-
-# others
-import configuration, connectome
+# The stage modules are imported on their first access, e.g. cmp.freesurfer,
+# so that importing cmp does not pull in the dependencies of all stages
+_lazy_modules = {
+    # PREPROCESSING
+    'preprocessing' : 'cmp.stages.preprocessing.organize',
+    # DICOM CONVERTER
+    'dicomconverter' : 'cmp.stages.converter.dicomconverter',
+    # REGISTRATION
+    'registration' : 'cmp.stages.registration.registration',
+    # FREESURFER
+    'freesurfer' : 'cmp.stages.segmentation.freesurfer',
+    # MASK: ROI_HR_th.nii / fsmask_1mm.nii CREATION
+    'maskcreation' : 'cmp.stages.parcellation.maskcreation',
+    # DIFFUSION TOOLKIT
+    'dtk' : 'cmp.stages.reconstruction.dtk',
+    # REGISTRATION: Apply registration ROI/WM --> b0
+    'apply_registration' : 'cmp.stages.registration.apply_registration',
+    # TRACTOGRAPHY
+    'tractography' : 'cmp.stages.tractography.tractography',
+    # FIBER FILTERING
+    'fiberfilter' : 'cmp.stages.postprocessing.fiberfilter',
+    # FIBER CLUSTERING
+    'fiberclustering' : 'cmp.stages.postprocessing.fiberclustering',
+    # CONNECTION MATRIX
+    'connectionmatrix' : 'cmp.stages.connectionmatrix.creatematrix',
+    # STATISTICS
+    'fiberstatistics' : 'cmp.stages.stats.fiber_statistics',
+    # CFF CONVERTER
+    'cffconverter' : 'cmp.stages.converter.cffconverter',
+    # Pipeline Status
+    'pipeline_status' : 'cmp.pipeline.pipeline_status',
+    # others
+    'configuration' : 'cmp.configuration',
+    'connectome' : 'cmp.connectome',
+    }
+
+class _LazyPackage(types.ModuleType):
+    """ The cmp package, importing the modules of _lazy_modules when they are
+    first accessed """
+
+    # keep the module replaced by this package alive, its globals are
+    # cleared once it is garbage collected
+    _module = sys.modules[__name__]
+
+    def __getattr__(self, name):
+        if not name in _lazy_modules:
+            raise AttributeError("'module' object has no attribute '%s'" % name)
+        fullname = _lazy_modules[name]
+        __import__(fullname)
+        mod = sys.modules[fullname]
+        setattr(self, name, mod)
+        return mod
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys() + _lazy_modules.keys()))
+
+_package = _LazyPackage(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+sys.modules[__name__] = _package
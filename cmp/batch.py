@@ -0,0 +1,154 @@
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" Run the pipeline for a cohort of subjects, given by their saved
+configuration states, with the stages of all subjects sharing one budget
+of cpus """
+
+import sys
+import logging
+import cmp
+from cmp.connectome import setup_pipeline_status, run_subjects_parallel
+
+# number of cpus used by stages by default, by short stage name: recon-all
+# is heavy on cpu and memory, the conversions are light
+DEFAULT_WEIGHTS = { 'freesurfer' : 4,
+                    'dicomconverter' : 1,
+                    'cffconverter' : 1 }
+
+def get_batch_logger():
+    """ The logger reporting the progress of a batch on the console, the
+    subject log files only get the messages of their subject """
+    log = logging.getLogger('batch')
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter( logging.Formatter("%(levelname)-8s : %(asctime)s : %(name)-10s : %(message)s") )
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        log.propagate = False
+    return log
+
+def subject_logger_name(cobj, i):
+    """ The name of the logger of the i-th subject, a child of the batch
+    logger """
+    name = '%s_%s' % (cobj.subject_name, cobj.subject_timepoint)
+    return 'batch.%i_%s' % (i, name.replace('.', '_'))
+
+def load_configuration(cmpconfigfile):
+    """ Load a configuration state saved with the GUI """
+    from cmp.gui import CMPGUI
+    cobj = CMPGUI()
+    cobj.load_state(cmpconfigfile)
+    return cobj
+
+def stage_weights(weights, stages):
+    """ Returns the weights, given by full or short stage name, by the full
+    name of the stages """
+    if weights is None:
+        return None
+    full = {}
+    for stage, stageEnabled in stages:
+        short = stage.__name__.split('.')[-1]
+        for k in [stage.__name__, short]:
+            if k in weights:
+                full[stage.__name__] = weights[k]
+    return full
+
+def batch(cmpconfigfiles, cpus, weights = None, resume = True):
+    """ Run the pipeline for all subjects
+
+    Parameters
+    ----------
+    cmpconfigfiles : list
+        the saved configuration state of each subject
+    cpus : int
+        number of cpus used by the stages of all subjects running at once
+    weights : dict, optional
+        number of cpus used by stages, by full or short stage name, e.g.
+        { 'freesurfer' : 2 }, overriding DEFAULT_WEIGHTS. The other stages
+        give it themselves.
+    resume : bool
+        skip the stages which were completed by a previous run, as given by
+        the pipeline status of the subject
+
+    Returns
+    -------
+    failed : dict
+        the configuration files of the subjects which failed and the name of
+        the stage which failed
+
+    """
+    log = get_batch_logger()
+    all_weights = dict(DEFAULT_WEIGHTS)
+    if not weights is None:
+        all_weights.update(weights)
+    subjects = []
+    fnames = []
+    failed = {}
+    for i, fname in enumerate(cmpconfigfiles):
+        try:
+            cobj = load_configuration(fname)
+            # each subject logs to its own files, and to the console through
+            # the batch logger
+            cobj.subject_logger_name = subject_logger_name(cobj, i)
+            if resume:
+                cobj.skip_completed_stages = True
+            cobj.consistency_check()
+            stages = setup_pipeline_status(cobj)
+            cmp.preprocessing.run( cobj )
+            cobj.pipeline_status.SetLoggerFunctions(cobj.get_logger().error, cobj.get_logger().info)
+        except Exception, e:
+            log.error( "Could not set up the subject of %s: %s" % (fname, e) )
+            failed[fname] = 'setup'
+            continue
+        subjects.append( (cobj, stages) )
+        fnames.append(fname)
+
+    log.info( "Run %i subjects with %i cpus" % (len(subjects), cpus) )
+    all_stages = []
+    for cobj, stages in subjects:
+        all_stages.extend(stages)
+    result = run_subjects_parallel(subjects, cpus, log, stage_weights(all_weights, all_stages))
+
+    for fname, stage in zip(fnames, result):
+        if stage:
+            failed[fname] = stage
+    log.info( "%i of %i subjects completed" % (len(cmpconfigfiles) - len(failed), len(cmpconfigfiles)) )
+    for fname in sorted(failed.keys()):
+        log.error( "Subject of %s failed in stage '%s'" % (fname, failed[fname]) )
+
+    return failed
+
+def main(argv):
+    """ Command line entry point, see connectomemapper_batch --help """
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] config.pkl [config.pkl ...]",
+                          description = "Run the Connectome Mapper for all subjects given by their "
+                                        "saved configuration states, sharing a budget of cpus")
+    parser.add_option('-c', '--cpus', type = 'int', default = 1,
+                      help = 'number of cpus used by the stages running at once [default: %default]')
+    parser.add_option('-w', '--weight', action = 'append', default = [], metavar = 'STAGE=CPUS',
+                      help = 'number of cpus used by a stage, e.g. freesurfer=2, can be repeated [default: %s]' %
+                             ' '.join(['%s=%i' % kv for kv in sorted(DEFAULT_WEIGHTS.items())]))
+    parser.add_option('--no-resume', dest = 'resume', action = 'store_false', default = True,
+                      help = 'run the stages completed by a previous run again')
+    (options, args) = parser.parse_args(argv)
+    if len(args) == 0:
+        parser.error('no configuration given')
+
+    weights = {}
+    for w in options.weight:
+        try:
+            k, v = w.split('=')
+            weights[k] = int(v)
+        except ValueError:
+            parser.error('invalid stage weight: %s' % w)
+
+    failed = batch(args, options.cpus, weights, options.resume)
+    return len(failed) > 0 and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
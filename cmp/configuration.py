@@ -34,6 +34,8 @@ class PipelineConfiguration(traits.HasTraits):
     
     # parcellation scheme
     parcellation_scheme = traits.Enum("NativeFreesurfer", ["Lausanne2008", "NativeFreesurfer"], desc="used parcellation scheme")
+    native_label_rasterization = traits.Bool(False, desc='rasterize the cortical labels of the Lausanne2008 parcellation in process instead of with mri_label2vol')
+    parcellation_processes = traits.Int(1, desc='number of processes creating the ROI volumes of the parcellation scales in parallel')
     
     # choose between 'L' (linear) and 'N' (non-linear)
     registration_mode = traits.Enum("Linear", ["Linear", "Nonlinear"], desc="registration mode: linear or non-linear")
@@ -81,6 +83,8 @@ class PipelineConfiguration(traits.HasTraits):
     subject_timepoint = traits.Str( )
     subject_workingdir = traits.Directory()
     subject_logger = None
+    # name of the logger of the subject, None logs through the root logger
+    subject_logger_name = None
     subject_metadata = [KeyValue(key='description', value=''),
                         KeyValue(key='', value=''),
                         KeyValue(key='', value=''),
@@ -101,6 +105,8 @@ class PipelineConfiguration(traits.HasTraits):
     active_statistics = traits.Bool(False)
     active_cffconverter = traits.Bool(False)
     skip_completed_stages = traits.Bool(False)
+    check_stage_content = traits.Bool(False, desc='compare the size and content digest of the stage inputs instead of their timestamps to skip completed stages')
+    cpu_budget = traits.Int(1, desc='number of cpus used by the stages running at once, independent stages run in parallel if more than 1')
 
     # metadata
     creator = traits.Str()
@@ -164,10 +170,16 @@ class PipelineConfiguration(traits.HasTraits):
 
     # connectome creation
     compute_curvature = traits.Bool(False)
+    connectome_processes = traits.Int(1, desc='number of processes creating the connection matrices of the resolutions in parallel')
+    compute_tract_profiles = traits.Bool(False, desc='store the mean trilinearly interpolated profile of the measures along the fibers of each edge')
+    tract_profile_nodes = traits.Int(20, desc='number of points of the tract profiles')
 
     # email notification, needs a local smtp server
     # sudo apt-get install postfix
     emailnotify = traits.ListStr([], desc='the email address to send stage completion status message')
+
+    # independent external commands of a stage run at once
+    command_processes = traits.Int(1, desc='number of independent external commands run at once, they run one after the other if 1')
     
     freesurfer_home = traits.Directory(exists=False, desc="path to Freesurfer")
     fsl_home = traits.Directory(exists=False, desc="path to FSL")
@@ -177,8 +189,8 @@ class PipelineConfiguration(traits.HasTraits):
     # CMP pipeline.  It can be queried using the PipelineStatus python object 
     pipeline_status_file = traits.Str( "cmp.status" )
     
-    # Pipeline status object
-    pipeline_status = pipeline_status.PipelineStatus()
+    # Pipeline status object, one for each configuration
+    pipeline_status = traits.Any(transient=True)
 
     def _get_lausanne_parcellation(self, parcel = "NativeFreesurfer"):
         
@@ -246,6 +258,8 @@ class PipelineConfiguration(traits.HasTraits):
         self.parcellation = self._get_lausanne_parcellation(parcel = "NativeFreesurfer")
 
         self.can_use_dipy = dipy_here
+
+        self.pipeline_status = pipeline_status.PipelineStatus()
                 
         # no email notify
         self.emailnotify = []
@@ -295,6 +309,9 @@ class PipelineConfiguration(traits.HasTraits):
         if self.subject_workingdir == '':
             msg = 'No working directory defined for subject'
             raise Exception(msg)
+
+        if self.compute_tract_profiles and self.tract_profile_nodes < 2:
+            raise Exception('Tract profiles need at least 2 nodes!')
 #        else:
 #            wdir = self.get_subj_dir()
 #            if not op.exists(wdir):
@@ -338,7 +355,7 @@ class PipelineConfiguration(traits.HasTraits):
         if self.subject_logger is None:
             # setup logger for the subject
             self.subject_logger = \
-                getLog(os.path.join(self.get_log(), self.get_logname())) 
+                getLog(os.path.join(self.get_log(), self.get_logname()), self.subject_logger_name) 
             return self.subject_logger
         else: 
             return self.subject_logger
@@ -617,6 +634,9 @@ class PipelineConfiguration(traits.HasTraits):
         """Create the 'cmp.status'.  The 'cmp.status' file contains information
         about the inputs/outputs of each pipeline stage"""        
         status_file = op.join(self.get_subj_dir(), self.pipeline_status_file)   
+        # start from a new status, the stages are declared again for this
+        # configuration only
+        self.pipeline_status = pipeline_status.PipelineStatus()
         self.pipeline_status.Pipeline.name = "cmp"
         self.pipeline_status.SaveToFile(status_file)
 
@@ -6,6 +6,8 @@
 
 # Connectome Mapping Execution Engine
 
+import sys
+import os.path as op
 import cmp
 from logme import *
 
@@ -40,6 +42,205 @@ def setup_pipeline_status(cobj):
     
     return stages
 
+def stage_to_run(cobj, stage):
+    """ Checks if the inputs of the stage exist, and returns False if the stage
+    was already completed and should be skipped """
+    curStageObj = cobj.pipeline_status.GetStage( stage.__name__ )
+
+    # Check if the inputs exist
+    if curStageObj != None:
+        if cobj.pipeline_status.CanRun( curStageObj ) == False:
+            # TODO: depending on the stage's missing file, point to required stages
+            msg = "Required input file missing for stage: '%s'. Please run all previous stages." % (stage.__name__)
+            cobj.get_logger().error( msg )
+            raise Exception( msg )
+        # If stage was already completed and user asked to skip completed stages, skip
+        # this stage.
+        elif (cobj.skip_completed_stages == True and
+              cobj.pipeline_status.RanOK( curStageObj,
+                                          checkTimestamp=True,
+                                          timestampRootFile=cobj.get_pipeline_status_file(),
+                                          checkContent=cobj.check_stage_content ) == True):
+            cobj.get_logger().info( "Skipping previously completed stage: '%s'" % ( stage.__name__) )
+            return False
+    return True
+
+def run_stage(cobj, stage):
+    """ Run the stage, recording the resource usage of its external commands
+    next to the pipeline status file """
+    if hasattr(stage, 'run'):
+        set_command_record( cobj.get_pipeline_status_file() + '.commands', stage.__name__ )
+        try:
+            stage.run( cobj )
+        finally:
+            set_command_record( None )
+
+def check_stage_outputs(cobj, stage):
+    """ Check if the stage ran properly and store the state of its inputs """
+    curStageObj = cobj.pipeline_status.GetStage( stage.__name__ )
+    if curStageObj != None:
+        if cobj.pipeline_status.RanOK( stage=curStageObj,
+                                       storeTimestamp=True,
+                                       timestampRootFile=cobj.get_pipeline_status_file(),
+                                       checkContent=cobj.check_stage_content ) == False:
+            msg = "Required output file not generated for stage: '%s'" % (stage.__name__)
+            cobj.get_logger().error( msg )
+            raise Exception( msg )
+
+def stage_cpus(cobj, stage, budget, weights = None):
+    """ The number of cpus used by the stage within the cpu budget, given by
+    weights, a dictionary by stage name, or by the stage itself """
+    cpus = 1
+    if not weights is None and stage.__name__ in weights:
+        cpus = weights[stage.__name__]
+    elif hasattr(stage, 'required_cpus'):
+        cpus = stage.required_cpus( cobj )
+    return max(1, min(cpus, budget))
+
+def stage_dependencies(cobj, stages):
+    """ Returns for each enabled stage the set of enabled stages producing its
+    inputs, as given by the inputs and outputs declared in the pipeline status.
+    A stage declaring no inputs depends on all enabled stages before it, an
+    incomplete declaration must not reorder the pipeline. """
+    g = cobj.pipeline_status.GenerateDependencyGraph()
+    order = [stage.__name__ for stage, stageEnabled in stages if stageEnabled == True]
+    enabled = set(order)
+    deps = {}
+    for i, name in enumerate(order):
+        curStageObj = cobj.pipeline_status.GetStage( name )
+        if curStageObj is None or len(curStageObj.inputs) == 0:
+            deps[name] = set(order[:i])
+        else:
+            deps[name] = set([p for p in g.predecessors(name) if p in enabled and p != name])
+    return deps
+
+def _stage_process(cobj, stage):
+    """ Run a stage in a child process of the scheduler """
+    try:
+        run_stage(cobj, stage)
+    except:
+        cobj.get_logger().exception( "Stage '%s' failed" % stage.__name__ )
+        sys.exit(1)
+
+def run_subjects_parallel(subjects, budget, log, weights = None):
+    """ Run the enabled stages of the subjects in child processes sharing a
+    budget of cpus. A stage starts as soon as the stages of its subject
+    producing its inputs completed and the cpus it uses fit into the budget.
+    The stages of the first subjects are started first.
+
+    Parameters
+    ----------
+    subjects : list
+        the (cobj, stages) of each subject, as returned by setup_pipeline_status
+    budget : int
+        number of cpus used by the stages running at once
+    log : logger
+        the logger reporting the progress
+    weights : dict, optional
+        number of cpus used by stages, by stage name
+
+    Returns
+    -------
+    failed : list
+        for each subject, the name of its stage which failed or None
+    """
+    import time, multiprocessing
+
+    pending = []
+    deps = []
+    done = []
+    failed = []
+    for cobj, stages in subjects:
+        pending.append([stage for stage, stageEnabled in stages if stageEnabled == True])
+        deps.append(stage_dependencies(cobj, stages))
+        done.append(set())
+        failed.append(None)
+    running = {}
+    free = budget
+
+    def subject_name(i):
+        return '%s %s' % (subjects[i][0].subject_name, subjects[i][0].subject_timepoint)
+
+    def progress(i):
+        n = len([s for s, e in subjects[i][1] if e == True])
+        log.info( "Subject %s: %i of %i stages completed" % (subject_name(i), len(done[i]), n) )
+
+    while True:
+        # start the stages whose inputs are ready, in the order of the
+        # subjects and of the pipeline. A stage waiting for cpus is not
+        # overtaken by the stages after it, so that it gets its cpus
+        waiting = False
+        for i, (cobj, stages) in enumerate(subjects):
+            for stage in list(pending[i]):
+                if not failed[i] is None or waiting:
+                    break
+                name = stage.__name__
+                if not deps[i][name] <= done[i]:
+                    continue
+                cpus = stage_cpus(cobj, stage, budget, weights)
+                if cpus > free:
+                    waiting = True
+                    break
+                pending[i].remove(stage)
+                try:
+                    if not stage_to_run(cobj, stage):
+                        done[i].add(name)
+                        continue
+                except Exception:
+                    failed[i] = name
+                    continue
+                log.info( "Subject %s: start stage '%s' using %i of %i free cpus" % (subject_name(i), name, cpus, free) )
+                p = multiprocessing.Process(target = _stage_process, args = (cobj, stage))
+                p.start()
+                running[(i, name)] = (p, stage, cpus)
+                free -= cpus
+
+            if failed[i] is None and pending[i] and not [k for k in running.keys() if k[0] == i] \
+               and [s for s in pending[i] if deps[i][s.__name__] <= done[i]] == []:
+                # no stage can start, their inputs are never produced
+                log.error( "Subject %s: circular stage dependencies: %s" %
+                           (subject_name(i), ', '.join([s.__name__ for s in pending[i]])) )
+                failed[i] = pending[i][0].__name__
+
+        if not running:
+            break
+
+        # wait for a stage to finish, the stages run for minutes to hours
+        finished = [k for k, (p, stage, cpus) in running.items() if not p.is_alive()]
+        if not finished:
+            time.sleep(1)
+            continue
+
+        for (i, name) in finished:
+            (p, stage, cpus) = running.pop((i, name))
+            p.join()
+            free += cpus
+            if p.exitcode != 0:
+                log.error( "Subject %s: stage '%s' failed with exit code %s, no further stage of the subject is started"
+                           % (subject_name(i), name, p.exitcode) )
+                failed[i] = failed[i] or name
+                continue
+            try:
+                check_stage_outputs(subjects[i][0], stage)
+            except Exception:
+                failed[i] = failed[i] or name
+                continue
+            done[i].add(name)
+            log.info( "Subject %s: stage '%s' completed" % (subject_name(i), name) )
+            progress(i)
+
+    return failed
+
+def run_stages_parallel(cobj, stages):
+    """ Run the enabled stages in child processes, each as soon as the stages
+    producing its inputs completed, as long as the cpus they use fit into
+    the cpu budget """
+    failed = run_subjects_parallel([(cobj, stages)], cobj.cpu_budget, cobj.get_logger())
+    if failed[0]:
+        msg = "Stage '%s' failed" % failed[0]
+        cobj.get_logger().error( msg )
+        raise Exception( msg )
+
 def mapit(cobj):
 
     cobj.consistency_check()
@@ -51,37 +252,19 @@ def mapit(cobj):
     # Set the logger function for the PipelineStatus object
     cobj.pipeline_status.SetLoggerFunctions(cobj.get_logger().error, cobj.get_logger().info)
 
-    # Execute the pipeline
+    # Execute the pipeline, independent stages at once if several cpus
+    # can be used
+    if cobj.cpu_budget > 1:
+        run_stages_parallel(cobj, stages)
+        return
+
     for stage, stageEnabled in stages:
         if stageEnabled == True:
-            curStageObj = cobj.pipeline_status.GetStage( stage.__name__ )
-
-            # Check if the inputs exist
-            if curStageObj != None:
-                if cobj.pipeline_status.CanRun( curStageObj ) == False:
-                    # TODO: depending on the stage's missing file, point to required stages
-                    msg = "Required input file missing for stage: '%s'. Please run all previous stages." % (stage.__name__)
-                    cobj.get_logger().error( msg )
-                    raise Exception( msg )
-                # If stage was already completed and user asked to skip completed stages, skip
-                # this stage.
-                elif (cobj.skip_completed_stages == True and
-                      cobj.pipeline_status.RanOK( curStageObj,
-                                                  checkTimestamp=True,
-                                                  timestampRootFile=cobj.get_pipeline_status_file() ) == True):
-                    cobj.get_logger().info( "Skipping previously completed stage: '%s'" % ( stage.__name__) )
-                    continue
+            if not stage_to_run(cobj, stage):
+                continue
 
             # Run the stage
-            if hasattr(stage, 'run'):
-                stage.run( cobj )
+            run_stage(cobj, stage)
 
             # Check if the stage ran properly
-            if curStageObj != None:
-                if cobj.pipeline_status.RanOK( stage=curStageObj,
-                                               storeTimestamp=True,
-                                               timestampRootFile=cobj.get_pipeline_status_file() ) == False:
-                    msg = "Required output file not generated for stage: '%s'" % (stage.__name__)
-                    cobj.get_logger().error( msg )
-                    raise Exception( msg )
-
+            check_stage_outputs(cobj, stage)
@@ -0,0 +1,494 @@
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" Packed storage of the fibers of a TrackVis file.
+
+The points of all fibers are stored in one contiguous float32 array of shape
+(N, 3), and the fiber i is points[offsets[i]:offsets[i+1]]. The arrays are
+stored as .npy files next to the track file, e.g. streamline_points.npy and
+streamline_offsets.npy for streamline.trk, and opened memory-mapped.
+"""
+
+import os, os.path as op
+import numpy as np
+import nibabel.trackvis as tv
+
+# number of fibers copied at once when packing or copying fibers
+CHUNK_SIZE = 100000
+
+class PackedFibers(object):
+    """ Fibers of a TrackVis file packed into contiguous arrays
+
+    Iterating yields (points, scalars, properties) tuples like
+    nibabel.trackvis.read, so a PackedFibers object can be passed to
+    nibabel.trackvis.write.
+    """
+
+    def __init__(self, points, offsets, hdr, scalars = None, properties = None, index = None):
+        self.points = points
+        self.offsets = offsets
+        self.hdr = hdr
+        self.scalars = scalars
+        self.properties = properties
+        # the indices of the selected fibers, None for all
+        self.index = index
+
+    def __len__(self):
+        if self.index is None:
+            return len(self.offsets) - 1
+        return len(self.index)
+
+    def __getitem__(self, i):
+        """ Returns the points of the i-th selected fiber """
+        j = self.fiber_index(i)
+        return self.points[self.offsets[j]:self.offsets[j+1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            j = self.fiber_index(i)
+            a, b = self.offsets[j], self.offsets[j+1]
+            sc = None
+            if not self.scalars is None:
+                sc = self.scalars[a:b]
+            pr = None
+            if not self.properties is None:
+                pr = self.properties[j]
+            yield (self.points[a:b], sc, pr)
+
+    def fiber_index(self, i = None):
+        """ Returns the index of the i-th selected fiber in the full store,
+        or the indices of all selected fibers if i is None """
+        if i is None:
+            if self.index is None:
+                return np.arange(len(self.offsets) - 1)
+            return self.index
+        if self.index is None:
+            return i
+        return self.index[i]
+
+    def subset(self, indices):
+        """ Returns the selection of the given fibers, without copying points.
+        indices can be an index array or a boolean mask """
+        indices = np.asarray(indices)
+        if indices.dtype == np.bool_:
+            indices = np.nonzero(indices)[0]
+        return PackedFibers(self.points, self.offsets, self.hdr, self.scalars,
+                            self.properties, self.fiber_index()[indices])
+
+    def number_of_points(self):
+        """ Returns the number of points of each selected fiber """
+        idx = self.fiber_index()
+        return self.offsets[idx+1] - self.offsets[idx]
+
+    def point_rows(self, a, b):
+        """ Returns the rows in points of the selected fibers a to b-1, as a
+        slice if they are contiguous, and their offsets into these rows """
+        idx = self.fiber_index()[a:b]
+        counts = self.offsets[idx+1] - self.offsets[idx]
+        offsets = np.zeros(len(idx) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(counts)
+        if self.index is None:
+            return (slice(self.offsets[a], self.offsets[b]), offsets)
+        base = self.offsets[idx] - offsets[:-1]
+        return (np.repeat(base, counts) + np.arange(offsets[-1]), offsets)
+
+    def iter_packed(self):
+        """ Yields (a, b, points, offsets) for the chunks of the selected
+        fibers a to b-1, with their packed points and offsets into them """
+        n = len(self)
+        for a in range(0, n, CHUNK_SIZE):
+            b = min(a + CHUNK_SIZE, n)
+            (rows, offsets) = self.point_rows(a, b)
+            yield (a, b, np.asarray(self.points[rows]), offsets)
+
+    def map_packed(self, func):
+        """ Apply func(points, offsets) to the packed points of the selected
+        fibers, chunk by chunk, and return the concatenated per-fiber results """
+        if len(self) == 0:
+            return np.zeros(0)
+        results = []
+        for a, b, points, offsets in self.iter_packed():
+            results.append( func(points, offsets) )
+        return np.concatenate(results)
+
+    def startpoints(self):
+        """ Returns the first point of each selected fiber """
+        return np.asarray(self.points[self.offsets[self.fiber_index()]])
+
+    def endpoints(self):
+        """ Returns the last point of each selected fiber """
+        return np.asarray(self.points[self.offsets[self.fiber_index()+1] - 1])
+
+
+def get_store_fnames(trkfile):
+    """ Returns a dictionary with the file names of the packed store of trkfile """
+    base = op.splitext(trkfile)[0]
+    fnames = {}
+    for k in ['points', 'offsets', 'scalars', 'properties']:
+        fnames[k] = '%s_%s.npy' % (base, k)
+    return fnames
+
+def read_header(trkfile):
+    """ Returns the TrackVis header of trkfile, without reading the fibers """
+    streams, hdr = tv.read(trkfile, as_generator = True)
+    return hdr
+
+def scan_trackvis(trkfile, hdr = None):
+    """ Locate the fiber records of a TrackVis file
+
+    Parameters
+    ----------
+    trkfile : the TrackVis file
+    hdr : its header, read if not given
+
+    Returns
+    -------
+    words : memory-mapped array
+        the file after its header as 4-byte words
+    starts : array (n,)
+        index into words of the record of each fiber
+    counts : array (n,)
+        the number of points of each fiber
+
+    """
+    if hdr is None:
+        hdr = read_header(trkfile)
+    endianness = hdr.dtype['hdr_size'].byteorder
+    pt_cols = 3 + int(hdr['n_scalars'])
+    n_p = int(hdr['n_properties'])
+    n_count = int(hdr['n_count'])
+
+    hdr_size = int(hdr['hdr_size'])
+    if op.getsize(trkfile) <= hdr_size:
+        return (np.zeros(0, dtype = endianness + 'i4'), np.zeros(0, dtype = np.int64),
+                np.zeros(0, dtype = np.int64))
+
+    words = np.memmap(trkfile, dtype = endianness + 'i4', mode = 'r', offset = hdr_size)
+    nwords = len(words)
+
+    starts = []
+    counts = []
+    pos = 0
+    while pos < nwords:
+        n = int(words[pos])
+        starts.append(pos)
+        counts.append(n)
+        pos += 1 + n * pt_cols + n_p
+        # a zero n_count means read until the end of the file
+        if len(starts) == n_count:
+            break
+
+    return (words, np.array(starts, dtype = np.int64), np.array(counts, dtype = np.int64))
+
+def point_words(starts, counts, pt_cols):
+    """ Returns the index into the scanned words of the first coordinate of
+    every point of the fibers with the given record starts and point counts """
+    counts = np.asarray(counts)
+    first = np.cumsum(counts) - counts
+    base = np.asarray(starts) + 1 - first * pt_cols
+    return np.repeat(base, counts) + np.arange(counts.sum()) * pt_cols
+
+def read_points(words, starts, counts, hdr):
+    """ Returns the points of the fibers with the given record starts and point
+    counts as one packed float32 array (m, 3) """
+    floats = words.view(words.dtype.byteorder + 'f4')
+    idx = point_words(starts, counts, 3 + int(hdr['n_scalars']))
+    points = np.empty( (len(idx), 3), dtype = np.float32 )
+    for c in range(3):
+        points[:, c] = floats[idx + c]
+    return points
+
+class TrackvisWriter(object):
+    """ Write a new TrackVis file by copying fiber records of a scanned source
+    file as they are stored, without decoding the fibers. The header is copied
+    from the source file and its n_count is set to the number of copied
+    fibers when closing. """
+
+    def __init__(self, dsttrk, srctrk, hdr):
+        self.hdr = hdr
+        self.pt_cols = 3 + int(hdr['n_scalars'])
+        self.n_p = int(hdr['n_properties'])
+        self.n = 0
+
+        f = open(srctrk, 'rb')
+        hdr_str = f.read(int(hdr['hdr_size']))
+        f.close()
+
+        self.out = open(dsttrk, 'wb')
+        self.out.write(hdr_str)
+
+    def copy(self, words, starts, counts):
+        """ Copy the records with the given starts and point counts """
+        if len(starts) == 0:
+            return
+        # the record of fiber i is words[starts[i]:starts[i] + sizes[i]]
+        sizes = 1 + np.asarray(counts) * self.pt_cols + self.n_p
+        ends = np.cumsum(sizes)
+        base = np.asarray(starts) - (ends - sizes)
+        idx = np.repeat(base, sizes) + np.arange(ends[-1])
+        self.out.write(words[idx].tostring())
+        self.n += len(starts)
+
+    def close(self):
+        """ Patch the number of fibers in the header and close the file """
+        self.out.seek(self.hdr.dtype.fields['n_count'][1])
+        self.out.write(np.array(self.n, dtype = self.hdr.dtype['n_count']).tostring())
+        self.out.close()
+
+def write_trackvis_subset(srctrk, dsttrk, indices):
+    """ Copy the selected fiber records of srctrk to the new TrackVis file dsttrk
+
+    The records are streamed chunk by chunk, so the fibers are never held in
+    memory.
+
+    Parameters
+    ----------
+    srctrk : the source TrackVis file
+    dsttrk : the TrackVis file to write
+    indices : index array or boolean mask of the fibers to copy
+
+    Returns
+    -------
+    n : the number of fibers written
+
+    """
+    hdr = read_header(srctrk)
+    (words, starts, counts) = scan_trackvis(srctrk, hdr)
+
+    indices = np.asarray(indices)
+    if indices.dtype == np.bool_:
+        indices = np.nonzero(indices)[0]
+
+    writer = TrackvisWriter(dsttrk, srctrk, hdr)
+    try:
+        for a in range(0, len(indices), CHUNK_SIZE):
+            idx = indices[a:a + CHUNK_SIZE]
+            writer.copy(words, starts[idx], counts[idx])
+    finally:
+        writer.close()
+
+    return writer.n
+
+def pack_trackvis(trkfile, log = None):
+    """ Read trkfile once and store its fibers packed next to it
+
+    Returns
+    -------
+    fibers : PackedFibers opened memory-mapped
+
+    """
+    if not log is None:
+        log.info("Pack the fibers of %s" % trkfile)
+
+    hdr = read_header(trkfile)
+    (words, starts, counts) = scan_trackvis(trkfile, hdr)
+    floats = words.view(words.dtype.byteorder + 'f4')
+    n_s = int(hdr['n_scalars'])
+    n_p = int(hdr['n_properties'])
+    pt_cols = 3 + n_s
+
+    n = len(counts)
+    offsets = np.zeros(n + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    fnames = get_store_fnames(trkfile)
+    np.save(fnames['offsets'], offsets)
+    points = np.lib.format.open_memmap(fnames['points'], mode = 'w+', dtype = np.float32,
+                                       shape = (offsets[-1], 3))
+    scalars = None
+    if n_s:
+        scalars = np.lib.format.open_memmap(fnames['scalars'], mode = 'w+', dtype = np.float32,
+                                            shape = (offsets[-1], n_s))
+    properties = None
+    if n_p:
+        properties = np.lib.format.open_memmap(fnames['properties'], mode = 'w+', dtype = np.float32,
+                                               shape = (n, n_p))
+
+    for a in range(0, n, CHUNK_SIZE):
+        b = min(a + CHUNK_SIZE, n)
+        first = offsets[a]
+        idx = point_words(starts[a:b], counts[a:b], pt_cols)
+        for c in range(3):
+            points[first:offsets[b], c] = floats[idx + c]
+        for c in range(n_s):
+            scalars[first:offsets[b], c] = floats[idx + 3 + c]
+        for c in range(n_p):
+            properties[a:b, c] = floats[starts[a:b] + 1 + counts[a:b] * pt_cols + c]
+
+    del points, scalars, properties
+
+    # remove a stale store part of a previous run
+    for k in ['scalars', 'properties']:
+        if (k == 'scalars' and not n_s) or (k == 'properties' and not n_p):
+            if op.exists(fnames[k]):
+                os.remove(fnames[k])
+
+    return open_packed(trkfile, hdr)
+
+def open_packed(trkfile, hdr = None, mmap_mode = 'r'):
+    """ Open the packed store of trkfile, which must exist """
+    if hdr is None:
+        hdr = read_header(trkfile)
+    fnames = get_store_fnames(trkfile)
+    points = np.load(fnames['points'], mmap_mode = mmap_mode)
+    offsets = np.load(fnames['offsets'])
+    scalars = None
+    if op.exists(fnames['scalars']):
+        scalars = np.load(fnames['scalars'], mmap_mode = mmap_mode)
+    properties = None
+    if op.exists(fnames['properties']):
+        properties = np.load(fnames['properties'], mmap_mode = mmap_mode)
+    return PackedFibers(points, offsets, hdr, scalars, properties)
+
+def is_packed(trkfile):
+    """ Returns True if trkfile has a packed store that is not older than it """
+    fnames = get_store_fnames(trkfile)
+    for k in ['points', 'offsets']:
+        if not op.exists(fnames[k]) or op.getmtime(fnames[k]) < op.getmtime(trkfile):
+            return False
+    return True
+
+def load_packed(trkfile, mmap_mode = 'r', log = None):
+    """ Returns the fibers of trkfile as PackedFibers, packing them first if
+    the store does not exist or is out of date """
+    if not is_packed(trkfile):
+        pack_trackvis(trkfile, log)
+    return open_packed(trkfile, mmap_mode = mmap_mode)
+
+def save_packed(fibers, trkfile):
+    """ Store the (selected) fibers as the packed store of trkfile """
+    fnames = get_store_fnames(trkfile)
+    idx = fibers.fiber_index()
+    counts = fibers.number_of_points()
+    n = len(idx)
+
+    offsets = np.zeros(n + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(counts)
+    np.save(fnames['offsets'], offsets)
+
+    points = np.lib.format.open_memmap(fnames['points'], mode = 'w+', dtype = np.float32,
+                                       shape = (offsets[-1], 3))
+    scalars = None
+    if not fibers.scalars is None:
+        scalars = np.lib.format.open_memmap(fnames['scalars'], mode = 'w+', dtype = np.float32,
+                                            shape = (offsets[-1], fibers.scalars.shape[1]))
+    elif op.exists(fnames['scalars']):
+        os.remove(fnames['scalars'])
+
+    for a in range(0, n, CHUNK_SIZE):
+        b = min(a + CHUNK_SIZE, n)
+        first = offsets[a]
+        (rows, chunkoffsets) = fibers.point_rows(a, b)
+        points[first:offsets[b]] = fibers.points[rows]
+        if not scalars is None:
+            scalars[first:offsets[b]] = fibers.scalars[rows]
+
+    del points, scalars
+
+    if not fibers.properties is None:
+        np.save(fnames['properties'], np.asarray(fibers.properties[idx]))
+    elif op.exists(fnames['properties']):
+        os.remove(fnames['properties'])
+
+def rename_packed(src, dst, log):
+    """ Rename the packed store of the track file src to the one of dst """
+    srcnames = get_store_fnames(src)
+    dstnames = get_store_fnames(dst)
+    for k in srcnames.keys():
+        if op.exists(srcnames[k]):
+            log.info("Rename %s to %s" % (srcnames[k], dstnames[k]))
+            os.rename(srcnames[k], dstnames[k])
+        elif op.exists(dstnames[k]):
+            os.remove(dstnames[k])
+
+def remove_packed(trkfile, log):
+    """ Remove the packed store of the track file trkfile """
+    for fname in get_store_fnames(trkfile).values():
+        if op.exists(fname):
+            log.info("Remove %s" % fname)
+            os.remove(fname)
+
+# size of the blocks read when hashing a track file
+DIGEST_BLOCKSIZE = 1 << 20
+
+def file_digest(fname):
+    """ Returns the md5 hex digest of the content of fname """
+    import hashlib
+    h = hashlib.md5()
+    f = open(fname, 'rb')
+    try:
+        block = f.read(DIGEST_BLOCKSIZE)
+        while block:
+            h.update(block)
+            block = f.read(DIGEST_BLOCKSIZE)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def get_cache_dir(trkfile):
+    """ Returns the directory caching the arrays derived from trkfile """
+    return op.join(op.dirname(trkfile), 'cache')
+
+def track_digest(trkfile):
+    """ Returns the content digest of trkfile. The digest is remembered in the
+    cache directory and only computed again if the size or the modification
+    time of trkfile change """
+    cachedir = get_cache_dir(trkfile)
+    record = op.join(cachedir, op.basename(trkfile) + '.digest')
+    st = os.stat(trkfile)
+    stamp = '%i %r' % (st.st_size, st.st_mtime)
+    if op.exists(record):
+        f = open(record)
+        lines = f.read().split('\n')
+        f.close()
+        if len(lines) >= 2 and lines[0] == stamp:
+            return lines[1]
+
+    digest = file_digest(trkfile)
+    if not op.exists(cachedir):
+        os.makedirs(cachedir)
+    f = open(record, 'w')
+    f.write('%s\n%s\n' % (stamp, digest))
+    f.close()
+    return digest
+
+def get_cached_dir(trkfile, digest, key):
+    """ Returns the directory of the arrays cached for the content digest of
+    trkfile under key """
+    base = op.splitext(op.basename(trkfile))[0]
+    return op.join(get_cache_dir(trkfile), '%s-%s-%s' % (base, digest, key))
+
+def load_cached(trkfile, digest, key, names):
+    """ Returns a dictionary with the arrays names cached for the content
+    digest of trkfile under key, or None if one of them is not cached """
+    cached = get_cached_dir(trkfile, digest, key)
+    arrays = {}
+    for k in names:
+        fname = op.join(cached, k + '.npy')
+        if not op.exists(fname):
+            return None
+        arrays[k] = np.load(fname)
+    return arrays
+
+def store_cached(trkfile, digest, key, arrays):
+    """ Cache the dictionary of arrays for the content digest of trkfile under
+    key. The arrays cached for other contents of trkfile are removed """
+    import shutil
+    base = op.splitext(op.basename(trkfile))[0]
+    cachedir = get_cache_dir(trkfile)
+    if op.exists(cachedir):
+        for d in os.listdir(cachedir):
+            if d.startswith(base + '-') and not d.startswith('%s-%s-' % (base, digest)):
+                shutil.rmtree(op.join(cachedir, d), ignore_errors = True)
+
+    cached = get_cached_dir(trkfile, digest, key)
+    if not op.exists(cached):
+        os.makedirs(cached)
+    for k, a in arrays.items():
+        # written under a temporary name, a cached array is always complete
+        tmp = op.join(cached, k + '.tmp.npy')
+        np.save(tmp, a)
+        os.rename(tmp, op.join(cached, k + '.npy'))
@@ -122,6 +122,8 @@ class CMPGUI( PipelineConfiguration ):
                         # Item('active_statistics', label = 'Statistics'),
                         Item('active_cffconverter', label = 'CFF Converter', tooltip='converts processed files to a connectome file'),
                         Item('skip_completed_stages', label = 'Skip Previously Completed Stages:'),
+                        Item('check_stage_content', label = 'Compare Input Contents:', tooltip = 'skip a completed stage only if the content of its inputs did not change', enabled_when = 'skip_completed_stages'),
+                        Item('cpu_budget', label = 'CPU Budget:', tooltip = 'number of cpus used by the stages running at once'),
                         label="Stages"     
                         ),
                         VGroup(
@@ -215,6 +217,8 @@ class CMPGUI( PipelineConfiguration ):
     parcellation_group = Group(
         VGroup(
                Item('parcellation_scheme', label="Parcellation Scheme"),
+               Item('native_label_rasterization', label="Native label rasterization", tooltip = 'rasterize the cortical labels in process instead of with mri_label2vol', enabled_when = 'parcellation_scheme == "Lausanne2008"'),
+               Item('parcellation_processes', label="Parallel processes", tooltip = 'number of parcellation scales processed in parallel'),
 #               VGroup(
 #                      Item('custompar_nrroi', label="Number of ROI"),
 #                      Item('custompar_nodeinfo', label="Node Information (GraphML)"),
@@ -318,6 +322,9 @@ class CMPGUI( PipelineConfiguration ):
     connectioncreation_group = Group(
         VGroup(
                Item('compute_curvature', label="Compute curvature"),
+               Item('connectome_processes', label="Parallel processes", tooltip = 'number of resolutions processed in parallel'),
+               Item('compute_tract_profiles', label="Compute tract profiles"),
+               Item('tract_profile_nodes', label="Tract profile nodes", enabled_when = "compute_tract_profiles"),
                Item('parcellation_scheme', label="Used Parcellation Scheme"),
                 VGroup(
                        Item('connection_P0', label="P0"),
@@ -366,6 +373,7 @@ class CMPGUI( PipelineConfiguration ):
     configuration_group = Group(
         VGroup(
                Item('emailnotify', label='E-Mail Notification'),
+               Item('command_processes', label='Parallel commands', tooltip = 'number of independent external commands run at once'),
                #Item('wm_handling', label='White Matter Mask Handling', tooltip = """1: run through the freesurfer step without stopping
 #2: prepare whitematter mask for correction (store it in subject dir/NIFTI
 #3: rerun freesurfer part with corrected white matter mask"""),
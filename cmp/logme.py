@@ -9,8 +9,20 @@
 
 import sys, os, os.path as op
 import logging, subprocess
+import errno, time, threading
+
+def getLog(fpath, name = None):
+    """ Returns the logger writing to the log file fpath, and its errors to
+    fpath.error.
+
+    By default the handlers are added to the root logger. If name is given,
+    they are added to the logger of this name only, e.g. one logger for each
+    subject of a batch. Such a logger has no console handler, its messages
+    reach the console through its parent loggers.
+    """
+    if not name is None and logging.getLogger( name ).handlers:
+        return logging.getLogger( name )
 
-def getLog(fpath):
     logFormat = "%(levelname)-8s : %(asctime)s : %(name)-10s : %(message)s"
     logFormatter = logging.Formatter( logFormat )
     
@@ -42,11 +54,15 @@ def getLog(fpath):
     filehandler2.setLevel( logging.ERROR )
     filehandler2.setFormatter( logFormatter )
 
-    logging.getLogger( '' ).addHandler( consolehandler )
-    logging.getLogger( '' ).addHandler( filehandler )
-    logging.getLogger( '' ).addHandler( filehandler2 )
-    
-    mainlog = logging.getLogger( "main" )
+    if name is None:
+        logging.getLogger( '' ).addHandler( consolehandler )
+        logging.getLogger( '' ).addHandler( filehandler )
+        logging.getLogger( '' ).addHandler( filehandler2 )
+        mainlog = logging.getLogger( "main" )
+    else:
+        mainlog = logging.getLogger( name )
+        mainlog.addHandler( filehandler )
+        mainlog.addHandler( filehandler2 )
     mainlog.setLevel( logging.DEBUG )
     
     return mainlog
@@ -66,68 +82,181 @@ def mkLocalLog( f ):
     return f
 
 
+# the file in which runCmd records the resource usage of each command, and
+# the stage running the commands, see set_command_record()
+_command_record = { 'file' : None, 'stage' : None }
+_command_record_lock = threading.Lock()
+
+def set_command_record(fname, stage = None):
+    """ Record the command line, wall time and resource usage of each command
+    run by runCmd in fname, one JSON object per line, tagged with stage.
+    No record is kept if fname is None """
+    _command_record['file'] = fname
+    _command_record['stage'] = stage
+
+def _wait_rusage( process ):
+    """ Wait for the process to terminate, set its returncode and return
+    its resource usage, which includes the processes it waited for """
+    while True:
+        try:
+            (pid, status, rusage) = os.wait4( process.pid, 0 )
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED( status ):
+        process.returncode = -os.WTERMSIG( status )
+    else:
+        process.returncode = os.WEXITSTATUS( status )
+    return rusage
+
+def _record_command( cmd, returncode, start, wall, rusage ):
+    """ Append the resource usage of a command to the command record """
+    if _command_record['file'] is None:
+        return
+    import json
+    rec = { 'cmd' : cmd, 'stage' : _command_record['stage'],
+            'returncode' : returncode, 'start' : start, 'wall' : wall,
+            'utime' : rusage.ru_utime, 'stime' : rusage.ru_stime,
+            'maxrss' : rusage.ru_maxrss,
+            'inblock' : rusage.ru_inblock, 'oublock' : rusage.ru_oublock }
+    _command_record_lock.acquire()
+    try:
+        try:
+            f = open( _command_record['file'], 'a' )
+            f.write( json.dumps( rec ) + '\n' )
+            f.close()
+        except IOError, e:
+            _localLog.warning( "Could not record command: %s" % e )
+    finally:
+        _command_record_lock.release()
+
 @mkLocalLog
 def runCmd( cmd, log ):
+    """ Run the shell command cmd, log its output line by line as it is
+    written and return its exit status. The resource usage of the command
+    is logged and recorded, see set_command_record() """
 
-    # timestamp for name
-    import random
-    t = random.randint(1, 10000000)
-    # create in temporary file
-    import tempfile
-    fname = op.join(tempfile.gettempdir(), "out_fifo_%s" % str(t))
+    start = time.time()
 
-    try:
-        os.unlink( fname )
-    except: pass
-    
-    os.mkfifo( fname )
+    # the output is read with blocking reads on the pipe, so no cpu time
+    # is spent while the command runs without writing anything
+    process = subprocess.Popen( cmd, shell = True, bufsize = -1,
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.STDOUT,
+                                close_fds = True )
+
+    log.debug( "Running: %s"%( cmd, ) )
 
     try:
-      
-        fifo = os.fdopen( os.open( fname,
-                                   os.O_RDONLY | os.O_NONBLOCK ) )
-    
-        newcmd = "( %s ) 1>%s 2>&1"%( cmd, fname )
-    
-        process = subprocess.Popen( newcmd, shell = True,
-                                    stdout = subprocess.PIPE,
-                                    stderr = subprocess.STDOUT )
-        
-        _localLog.debug( "Running: %s"%( cmd, ) )
-    
-        while process.returncode == None:
-            # None means process is still running
-    
-            # need to poll the process once so the returncode
-            # gets set (see docs)
-            process.poll()
-    
-            try:
-                line = fifo.readline().strip()
-            except:
-                continue
-    
+        for line in iter( process.stdout.readline, '' ):
+            line = line.strip()
             if line:
                 log.info( line )
-    
-        remaining = fifo.read()
-    
-        if remaining:
-            for line in [ line
-                          for line in remaining.split( "\n" )
-                          if line.strip() ]:
-                log.info( line.strip() )
-    
-        if process.returncode:
-            _localLog.critical( "Return Value: %s"%( process.returncode, ) )
-        else:
-            _localLog.debug( "Return Value: %s"%( process.returncode, ) )
-    
     finally:
-        try:
-            os.unlink( fname )
-        except:
-            _localLog.warning( "Failed to unlink '%s'." % fname)
+        process.stdout.close()
+        rusage = _wait_rusage( process )
+
+    wall = time.time() - start
+    _record_command( cmd, process.returncode, start, wall, rusage )
+
+    if process.returncode:
+        log.critical( "Return Value: %s"%( process.returncode, ) )
+    else:
+        log.debug( "Return Value: %s"%( process.returncode, ) )
+    log.debug( "Wall time: %.1fs, user: %.1fs, system: %.1fs, max rss: %i kB" %
+               ( wall, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss ) )
+
+    return process.returncode
+
+class _BufferedLog(object):
+    """ Collects the output lines logged by runCmd for one command of a batch """
+
+    def __init__(self):
+        self.lines = []
+
+    def debug(self, msg):
+        self.lines.append( (logging.DEBUG, msg) )
+
+    def info(self, msg):
+        self.lines.append( (logging.INFO, msg) )
+
+    def critical(self, msg):
+        self.lines.append( (logging.CRITICAL, msg) )
+
+def runCmds( cmds, log, processes = None, fail_fast = True ):
+    """ Run the independent shell commands cmds concurrently, at most
+    processes at once (default: the number of cpus).
+
+    The output of each command is logged in one block after it terminated,
+    in the order of cmds. If fail_fast is True, no further command is
+    started after one failed.
+
+    Returns the list of the exit status of the commands, None for the
+    commands which were not started.
+    """
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    n = len(cmds)
+    status = [None] * n
+    outputs = [None] * n
+    state = { 'next' : 0, 'logged' : 0, 'failed' : False }
+    lock = threading.Lock()
+
+    def log_finished():
+        # log the output of the finished commands up to the first running one
+        while state['logged'] < n and not outputs[state['logged']] is None:
+            i = state['logged']
+            log.info( "Output of: %s" % cmds[i] )
+            for level, line in outputs[i].lines:
+                log.log( level, line )
+            state['logged'] += 1
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if state['next'] >= n or (fail_fast and state['failed']):
+                    return
+                i = state['next']
+                state['next'] += 1
+            finally:
+                lock.release()
+
+            out = _BufferedLog()
+            ret = runCmd( cmds[i], out )
+
+            lock.acquire()
+            try:
+                status[i] = ret
+                outputs[i] = out
+                if ret:
+                    state['failed'] = True
+                log_finished()
+            finally:
+                lock.release()
+
+    threads = [ threading.Thread( target = worker ) for k in range( min( processes, n ) ) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the commands after a command which was not started
+    for i in range( state['logged'], n ):
+        if not outputs[i] is None:
+            log.info( "Output of: %s" % cmds[i] )
+            for level, line in outputs[i].lines:
+                log.log( level, line )
+
+    if state['failed']:
+        failed = [ cmds[i] for i in range(n) if status[i] ]
+        log.error( "%i of %i commands failed, first: %s" % ( len(failed), n, failed[0] ) )
+        if fail_fast and None in status:
+            log.error( "%i commands were not started" % status.count( None ) )
+
+    return status
 
 def GetInHMS(seconds):
     hours = seconds / 3600
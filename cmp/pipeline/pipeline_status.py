@@ -19,15 +19,32 @@ import sys
 import os
 import os.path as op
 import pickle
-import networkx as nx
 import glob
 
+# size of the blocks read when computing the digest of a file
+DIGEST_BLOCKSIZE = 1 << 20
+
+def FileDigest(filename):
+    """Returns the md5 hex digest of the content of a file, read block by block"""
+    import hashlib
+    h = hashlib.md5()
+    f = open(filename, 'rb')
+    try:
+        block = f.read(DIGEST_BLOCKSIZE)
+        while block:
+            h.update(block)
+            block = f.read(DIGEST_BLOCKSIZE)
+    finally:
+        f.close()
+    return h.hexdigest()
+
 class PipelineStatus():
     """Interface to Pipeline protocol buffer"""
            
     def __init__(self, filename=None):
         """Constructor"""
         self.Pipeline = pipeline_pb2.Pipeline()
+        self.__IndexStages()
         
         # By default, use stdin/stderr for logging
         self.logError = sys.stderr.write
@@ -50,6 +67,7 @@ class PipelineStatus():
             f.close()
         except:
             self.logError("Could not open file: " + filename)
+        self.__IndexStages()
         
     def SaveToFile(self, filename):
         """Load the pipeline state from a file"""
@@ -63,17 +81,20 @@ class PipelineStatus():
     def AddStage(self, name, clearExisting=False):
         """Add a new stage to the pipeline if it does not exist.  If it does already exist,
         just return the existing stage.  Returns the stage"""
-        for stage in self.Pipeline.stages:
-            if stage.name == name:
-                if clearExisting:
-                    # Clear the current inputs and outputs
-                    del stage.inputs[:]
-                    del stage.outputs[:]                                                            
-                return stage
+        if name in self.stagesByName:
+            stage = self.stagesByName[name]
+            if clearExisting:
+                # Clear the current inputs and outputs
+                del stage.inputs[:]
+                del stage.outputs[:]                                                            
+                self.inputsByStage.pop(name, None)
+            return stage
             
         newStage = self.Pipeline.stages.add()
         newStage.num = len(self.Pipeline.stages)
         newStage.name = name;        
+        self.stagesByName[name] = newStage
+        self.stagesByNum.setdefault(newStage.num, newStage)
         return newStage;
     
     def AddType(self, tag, description):
@@ -93,15 +114,11 @@ class PipelineStatus():
            name and number are given, it will search
            first for name, and then for number"""
            
-        if name != None:           
-            for stage in self.Pipeline.stages:
-                if stage.name == name:
-                    return stage
+        if name != None and name in self.stagesByName:
+            return self.stagesByName[name]
        
-        if num != None:
-            for stage in self.Pipeline.stages:
-                if stage.num == num:
-                    return stage         
+        if num != None and num in self.stagesByNum:
+            return self.stagesByNum[num]
 
         if name != None:
             self.logError('Pipeline does not contain stage %s' % (name))
@@ -112,9 +129,14 @@ class PipelineStatus():
     
     def GetStageInput(self, stage, name):
         """Get input to a stage by name"""        
-        for input in stage.inputs:
-            if input.name == name:
-                return input
+        if not stage.name in self.inputsByStage:
+            # index the inputs of the stage, the first input of a name is kept
+            index = {}
+            for input in stage.inputs:
+                index.setdefault(input.name, input)
+            self.inputsByStage[stage.name] = index
+        if name in self.inputsByStage[stage.name]:
+            return self.inputsByStage[stage.name][name]
             
         self.logError('Stage does not contain input %s' % (name))            
         return None
@@ -133,7 +155,7 @@ class PipelineStatus():
         # If we get here, then all files were found    
         return True
             
-    def RanOK(self, stage, storeTimestamp=False, checkTimestamp=False, timestampRootFile=''):
+    def RanOK(self, stage, storeTimestamp=False, checkTimestamp=False, timestampRootFile='', checkContent=False):
         """Determines if all stage outputs were produced
         
         Inputs
@@ -150,6 +172,11 @@ class PipelineStatus():
                                is for example, '/cmt.status', then the function
                                will read and/or write  /.cmt.status.N.timestamp (where N is
                                the stage number).                                 
+        checkContent:          if True, the size and a content digest of the inputs are
+                               stored and checked instead of their timestamps, so that
+                               touching or copying an input does not re-run the stage.
+                               The digests are cached by inode and timestamp in
+                               .cmt.status.digests (default: False)
         Outputs
         -------
         ranOK:                 boolean of whether stage ran succesfully
@@ -173,14 +200,17 @@ class PipelineStatus():
         if checkTimestamp == True or storeTimestamp == True:
             timestampFileName = op.join(op.dirname(timestampRootFile), '.%s.%d.timestamp' % 
                                         (op.basename(timestampRootFile), stage.num))
-            timestampList = []
-            for curInput in stage.inputs:
-                filePath = op.join(curInput.rootDir, curInput.filePath)
-                matchingFiles = glob.glob(filePath)
-                if len(matchingFiles) >= 1:
-                    for curFile in matchingFiles:
-                        statInfo = os.lstat(curFile)
-                        timestampList.append(statInfo.st_mtime)                        
+            if checkContent == True:
+                timestampList = self.__InputDigests(stage, timestampRootFile)
+            else:
+                timestampList = []
+                for curInput in stage.inputs:
+                    filePath = op.join(curInput.rootDir, curInput.filePath)
+                    matchingFiles = glob.glob(filePath)
+                    if len(matchingFiles) >= 1:
+                        for curFile in matchingFiles:
+                            statInfo = os.lstat(curFile)
+                            timestampList.append(statInfo.st_mtime)                        
             
         # If checkTimestamp is true, check to see if the stored timestamps match the
         # computed timestamps.  If not, need to re-run.            
@@ -226,6 +256,7 @@ class PipelineStatus():
     
         """
         newInput = stage.inputs.add()
+        self.inputsByStage.pop(stage.name, None)
         
         if inputName == None:
             inputName = inputFilePath
@@ -257,6 +288,7 @@ class PipelineStatus():
     def AddStageInputFromObject(self, stage, inputOutputObject):
         """Copy input or output as an input to another stage"""
         newInput = stage.inputs.add()
+        self.inputsByStage.pop(stage.name, None)
         newInput.filePath = inputOutputObject.filePath;
         newInput.name = inputOutputObject.name;
         newInput.rootDir = inputOutputObject.rootDir
@@ -274,22 +306,90 @@ class PipelineStatus():
         """Using networkx, generate a dependency graph that maps the
         dependencies between stages.
         """ 
+        import networkx as nx
         g = nx.DiGraph()
         for stage in self.Pipeline.stages:
             g.add_node(stage.name)
         
+        # Index the stages producing each output by its path
+        producers = {}
+        for searchStage in self.Pipeline.stages:
+            for output in searchStage.outputs:
+                stages = producers.setdefault((output.rootDir, output.filePath), [])
+                if not searchStage in stages:
+                    stages.append(searchStage)
+
         # Loop through the stages and connect the matching inputs and
         # outputs along edges
         for curStage in self.Pipeline.stages:
             for input in curStage.inputs:
-                for searchStage in self.Pipeline.stages:
+                for searchStage in producers.get((input.rootDir, input.filePath), []):
                     if curStage.num != searchStage.num:
-                        for output in searchStage.outputs:                        
-                            if input.filePath == output.filePath and input.rootDir == output.rootDir:
-                                g.add_edge(searchStage.name, curStage.name,name=input.name)
+                        g.add_edge(searchStage.name, curStage.name,name=input.name)
         return g                
         
     
+    def __InputDigests(self, stage, timestampRootFile):
+        """Returns a dictionary with the size and content digest of each input
+        file of the stage, by file path.  The digests are cached by inode and
+        timestamp, so that unchanged files are not read again"""
+        cacheFileName = op.join(op.dirname(timestampRootFile), '.%s.digests' %
+                                op.basename(timestampRootFile))
+        try:
+            f = open(cacheFileName, 'rb')
+            cache = pickle.load(f)
+            f.close()
+        except:
+            cache = {}
+
+        computed = {}
+        digests = {}
+        for curInput in stage.inputs:
+            filePath = op.join(curInput.rootDir, curInput.filePath)
+            for curFile in glob.glob(filePath):
+                statInfo = os.stat(curFile)
+                if not os.path.isfile(curFile):
+                    digests[curFile] = (None, statInfo.st_mtime)
+                    continue
+                key = (statInfo.st_dev, statInfo.st_ino)
+                stamp = (statInfo.st_size, statInfo.st_mtime)
+                if not key in cache or cache[key][0] != stamp:
+                    cache[key] = (stamp, FileDigest(curFile))
+                    computed[key] = cache[key]
+                digests[curFile] = (statInfo.st_size, cache[key][1])
+
+        if computed:
+            # stages running in parallel share the cache: add the computed
+            # digests to the current cache file, and replace it at once so
+            # that it is never read half written
+            try:
+                f = open(cacheFileName, 'rb')
+                cache = pickle.load(f)
+                f.close()
+            except:
+                cache = {}
+            cache.update(computed)
+            tmpFileName = '%s.%d.tmp' % (cacheFileName, os.getpid())
+            try:
+                f = open(tmpFileName, 'wb')
+                pickle.dump(cache, f)
+                f.close()
+                os.rename(tmpFileName, cacheFileName)
+            except:
+                self.logError("Could not write digests to '%s'" % (cacheFileName))
+        return digests
+
+    def __IndexStages(self):
+        """Index the stages by name and number, and drop the indexes of
+        their inputs"""
+        self.stagesByName = {}
+        self.stagesByNum = {}
+        # the first stage of a name or number is found, as by a linear search
+        for stage in self.Pipeline.stages:
+            self.stagesByName.setdefault(stage.name, stage)
+            self.stagesByNum.setdefault(stage.num, stage)
+        self.inputsByStage = {}
+
     def __AddStageInputOutput(self, inputOutput, rootDir, filePath, name, typeTag):
         """Used internally for adding stage input/output """
         inputOutput.filePath = filePath
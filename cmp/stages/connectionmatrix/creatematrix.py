@@ -7,36 +7,35 @@
 import os, os.path as op
 from time import time
 from glob import glob
+import multiprocessing
 import numpy as np
 import nibabel
 import networkx as nx
 from ...logme import *
-from cmp.util import mean_curvature, length
+from cmp.util import mean_curvature_packed, length_packed, resample_packed, label_centroids
+import cmp.fiberstore as fiberstore
+from cmp.utility.sparseconnectome import save_sparse_connectome, load_sparse_connectome
+
+# read-only inputs of cmat_resolution(), set up by cmat() before the
+# resolution workers are forked
+shared = {}
 
 def compute_curvature_array(fib):
     """ Computes the curvature array """
     log.info("Compute curvature ...")
     
     n = len(fib)
-    pc        = -1
-    meancurv = np.zeros( (n, 1) )
-    for i, fi in enumerate(fib):
-        # Percent counter
-        pcN = int(round( float(100*i)/n ))
-        if pcN > pc and pcN%1 == 0:    
-            pc = pcN
-            log.info('%4.0f%%' % (pc))
-        meancurv[i,0] = mean_curvature(fi[0])
+    meancurv = fib.map_packed(mean_curvature_packed).reshape( (n, 1) )
 
-    return meancurv
     log.info("DONE")
+    return meancurv
 
 def create_endpoints_array(fib, voxelSize):
     """ Create the endpoints arrays for each fiber
         
     Parameters
     ----------
-    fib: the fibers data
+    fib: the fibers data, as PackedFibers
     voxelSize: 3-tuple containing the voxel size of the ROI image
     
     Returns
@@ -50,65 +49,425 @@ def create_endpoints_array(fib, voxelSize):
     log.info("========================")
     log.info("create_endpoints_array")
     
-    # Init
     n         = len(fib)
-    endpoints = np.zeros( (n, 2, 3) )
     endpointsmm = np.zeros( (n, 2, 3) )
-    pc        = -1
 
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-    
-        # Percent counter
-        pcN = int(round( float(100*i)/n ))
-        if pcN > pc and pcN%1 == 0:    
-            pc = pcN
-            log.info('%4.0f%%' % (pc))
+    # store startpoint and endpoint
+    endpointsmm[:,0,:] = fib.startpoints()
+    endpointsmm[:,1,:] = fib.endpoints()
+
+    # Translate from mm to index
+    endpoints = np.trunc( endpointsmm / np.array(voxelSize, dtype = np.float64) )
 
-        f = fi[0]
-    
-        # store startpoint
-        endpoints[i,0,:] = f[0,:]
-        # store endpoint
-        endpoints[i,1,:] = f[-1,:]
-        
-        # store startpoint
-        endpointsmm[i,0,:] = f[0,:]
-        # store endpoint
-        endpointsmm[i,1,:] = f[-1,:]
-        
-        # Translate from mm to index
-        endpoints[i,0,0] = int( endpoints[i,0,0] / float(voxelSize[0]))
-        endpoints[i,0,1] = int( endpoints[i,0,1] / float(voxelSize[1]))
-        endpoints[i,0,2] = int( endpoints[i,0,2] / float(voxelSize[2]))
-        endpoints[i,1,0] = int( endpoints[i,1,0] / float(voxelSize[0]))
-        endpoints[i,1,1] = int( endpoints[i,1,1] / float(voxelSize[1]))
-        endpoints[i,1,2] = int( endpoints[i,1,2] / float(voxelSize[2]))
-        
-    # Return the matrices  
-    return (endpoints, endpointsmm)  
-    
     log.info("done")
     log.info("========================")
 
-def save_fibers(oldhdr, oldfib, fname, indices):
-    """ Stores a new trackvis file fname using only given indices """
+    # Return the matrices  
+    return (endpoints, endpointsmm)  
+
+def label_fibers(endpoints, roiData, nROIs):
+    """ Label all fibers at once with the ROIs their endpoints terminate in
 
-    hdrnew = oldhdr.copy()
+    Parameters
+    ----------
+    endpoints : array (n, 2, 3)
+        voxel indices of the first and last point of each fiber
+    roiData : array (I, J, K)
+        the ROI volume
+    nROIs : int
+        number of regions of the parcellation
+
+    Returns
+    -------
+    fiberlabels : array (n, 2) int32
+        sorted (startROI <= endROI) labels of the valid fibers; orphan
+        fibers are marked with -1 in the first column, fibers outside of the
+        volume or with a label higher than nROIs are left at zero
+    final_fibers_idx : array
+        indices of the valid fibers, in increasing order
+    outside : boolean array (n,)
+        fibers with a start or endpoint outside of the volume
+    orphans : boolean array (n,)
+        fibers that start or terminate in a voxel which is not labeled
+
+    """
+    n = endpoints.shape[0]
+    ep = np.asarray(endpoints).astype(np.intp)
+
+    # mask out fibers with an endpoint outside of the volume
+    shape = np.array(roiData.shape[:3])
+    outside = ((ep < 0) | (ep >= shape)).reshape(n, 6).any(axis=1)
+    inside = ~outside
 
-    outstreams = []
-    for i in indices:
-        outstreams.append( oldfib[i] )
+    # one lookup for both endpoints of all fibers inside the volume
+    labels = np.zeros( (n, 2), dtype = np.int32 )
+    epin = ep[inside]
+    labels[inside] = roiData[epin[:,:,0], epin[:,:,1], epin[:,:,2]]
 
-    n_fib_out = len(outstreams)
-    hdrnew['n_count'] = n_fib_out
+    orphans = inside & ((labels[:,0] == 0) | (labels[:,1] == 0))
+    toohigh = inside & ~orphans & (labels > nROIs).any(axis=1)
+    valid = inside & ~orphans & ~toohigh
+
+    if toohigh.any():
+        log.debug("%i fibers terminate in a voxel which is labeled higher" % toohigh.sum())
+        log.debug("than is expected by the parcellation node information.")
+        log.debug("This needs bugfixing!")
+
+    # enforce startROI < endROI
+    fiberlabels = np.zeros( (n, 2), dtype = np.int32 )
+    fiberlabels[orphans, 0] = -1
+    fiberlabels[valid] = np.sort(labels[valid], axis = 1)
+
+    final_fibers_idx = np.nonzero(valid)[0]
+
+    return (fiberlabels, final_fibers_idx, outside, orphans)
+
+def group_fibers_by_edge(fiberlabels):
+    """ Group fibers sharing the same (startROI, endROI) label pair
+
+    Parameters
+    ----------
+    fiberlabels : array (m, 2)
+        sorted label pairs of the valid fibers
+
+    Returns
+    -------
+    edges : array (e, 2)
+        the distinct label pairs, in increasing order
+    order : array (m,)
+        row indices into fiberlabels, grouped by edge and increasing within
+        each edge
+    bounds : array (e+1,)
+        the rows of edge k are order[bounds[k]:bounds[k+1]]
+
+    """
+    m = fiberlabels.shape[0]
+    if m == 0:
+        return (np.zeros( (0, 2), dtype = np.int32 ), np.zeros(0, dtype = np.intp),
+                np.zeros(1, dtype = np.intp))
+
+    start = fiberlabels[:,0].astype(np.int64)
+    end = fiberlabels[:,1].astype(np.int64)
+    key = start * (end.max() + 1) + end
+
+    # a stable sort keeps the fibers of each edge in increasing order
+    order = np.argsort(key, kind = 'mergesort')
+    skey = key[order]
+    first = np.concatenate( ([0], np.nonzero(np.diff(skey))[0] + 1) )
+    bounds = np.append(first, m)
+    edges = fiberlabels[order[first]]
+
+    return (edges, order, bounds)
+
+def grouped_mean_std(values, bounds):
+    """ Mean and standard deviation of values over contiguous segments
+
+    Parameters
+    ----------
+    values : array (m,)
+        values ordered by segment
+    bounds : array (e+1,)
+        segment k is values[bounds[k]:bounds[k+1]], segments must not be empty
+
+    Returns
+    -------
+    (mean, std) : arrays (e,)
+
+    """
+    counts = np.diff(bounds)
+    if len(counts) == 0:
+        return (np.zeros(0), np.zeros(0))
+
+    values = np.asarray(values, dtype = np.float64)
+    mean = np.add.reduceat(values, bounds[:-1]) / counts
+    # two-pass variance, as computed by np.std
+    dev = values - np.repeat(mean, counts)
+    std = np.sqrt( np.add.reduceat(dev * dev, bounds[:-1]) / counts )
+
+    return (mean, std)
+
+def save_fibers(intrk, fname, indices):
+    """ Stores a new trackvis file fname using only given indices of intrk """
 
     log.info("Writing final no orphan fibers: %s" % fname)
-    nibabel.trackvis.write(fname, outstreams, hdrnew)
+    fiberstore.write_trackvis_subset(intrk, fname, indices)
+
+
+def get_measure_files(conf = None):
+    """ Returns a dictionary with the scalar measure names enabled for the
+    connection matrix and their file names in the scalars folder, for the
+    configuration conf or by default the one of the running stage """
+
+    if conf is None:
+        conf = gconf
+    mmap = {}
+    if conf.diffusion_imaging_model == 'DSI':
+        if conf.connection_P0:
+            mmap['P0'] = 'dsi_P0.nii.gz'
+        if conf.connection_gfa:
+            mmap['gfa'] = 'dsi_gfa.nii.gz'
+        if conf.connection_kurtosis:
+            mmap['kurtosis'] = 'dsi_kurtosis.nii.gz'
+        if conf.connection_skewness:
+            mmap['skewness'] = 'dsi_skewness.nii.gz'
+
+    elif conf.diffusion_imaging_model == 'DTI':
+        if conf.connection_adc:
+            mmap['adc'] = 'dti_adc.nii.gz'
+        if conf.connection_fa:
+            mmap['fa'] = 'dti_fa.nii.gz'
+
+    elif conf.diffusion_imaging_model == 'QBALL':
+        if conf.connection_P0:
+            mmap['P0'] = 'hardi_P0.nii.gz'
+        if conf.connection_gfa:
+            mmap['gfa'] = 'hardi_gfa.nii.gz'
+        if conf.connection_kurtosis:
+            mmap['kurtosis'] = 'hardi_kurtosis.nii.gz'
+        if conf.connection_skewness:
+            mmap['skewness'] = 'hardi_skewness.nii.gz'
+
+    return mmap
+
+def scalar_sums_packed(points, offsets, data, zooms):
+    """ Sample a scalar volume at all points of packed fibers
+
+    Parameters
+    ----------
+    points : array (N, 3)
+        the points of the fibers in milimeter, one fiber after the other
+    offsets : array (n+1,)
+        the points of fiber i are points[offsets[i]:offsets[i+1]]
+    data : array
+        the scalar volume
+    zooms : tuple
+        the voxel size of the scalar volume
+
+    Returns
+    -------
+    sums : array (n, 3)
+        for each fiber, the sum and the sum of squares of the values at its
+        points, and 1 if one of its points lies outside the volume
+
+    """
+    points = np.asarray(points)
+    offsets = np.asarray(offsets)
+    n = len(offsets) - 1
+    sums = np.zeros( (n, 3) )
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    if not nonempty.any():
+        return sums
+
+    # all points are converted to voxel indices at once
+    vox = np.trunc( points / np.asarray(zooms[:3], dtype = points.dtype) ).astype(np.intp)
+    shape = np.array(data.shape[:3])
+    inside = ((vox >= 0) & (vox < shape)).all(axis = 1)
+
+    # one gather for the points inside the volume
+    val = np.zeros(len(points))
+    vox = vox[inside]
+    val[inside] = data[vox[:,0], vox[:,1], vox[:,2]]
+
+    start = offsets[:-1][nonempty]
+    sums[nonempty,0] = np.add.reduceat(val, start)
+    sums[nonempty,1] = np.add.reduceat(val * val, start)
+    sums[nonempty,2] = np.add.reduceat((~inside).astype(np.float64), start) > 0
+
+    return sums
+
+def sample_scalar_volume(fib, data, zooms):
+    """ Per fiber sums of a scalar volume sampled along the fibers
 
+    Returns
+    -------
+    (sums, sumsq, outside) : arrays (n,)
+        the sum and sum of squares of the values along each fiber, and a mask
+        of the fibers with points outside of the volume
+
+    """
+    sums = fib.map_packed(lambda p, o: scalar_sums_packed(p, o, data, zooms))
+    sums = sums.reshape( (len(fib), 3) )
+    return (sums[:,0], sums[:,1], sums[:,2] > 0)
+
+def grouped_scalar_mean_std(sums, sumsq, npoints, bounds):
+    """ Mean and standard deviation of the values along all fibers of
+    contiguous segments, from the per fiber sums
+
+    Parameters
+    ----------
+    sums, sumsq, npoints : arrays (m,)
+        sum and sum of squares of the values along each fiber, and its
+        number of points, ordered by segment
+    bounds : array (e+1,)
+        segment k is sums[bounds[k]:bounds[k+1]], segments must not be empty
+
+    Returns
+    -------
+    (mean, std) : arrays (e,)
+        nan for segments without points
+
+    """
+    if len(bounds) < 2:
+        return (np.zeros(0), np.zeros(0))
+
+    count = np.add.reduceat(np.asarray(npoints, dtype = np.float64), bounds[:-1])
+    total = np.add.reduceat(sums, bounds[:-1])
+    totalsq = np.add.reduceat(sumsq, bounds[:-1])
+
+    mean = np.empty(len(count))
+    mean.fill(np.nan)
+    std = mean.copy()
+    valid = count > 0
+    mean[valid] = total[valid] / count[valid]
+    var = totalsq[valid] / count[valid] - mean[valid] ** 2
+    std[valid] = np.sqrt( np.maximum(var, 0) )
+
+    return (mean, std)
+
+def interpolate_trilinear(data, coords):
+    """ Trilinear interpolation of a volume
+
+    Parameters
+    ----------
+    data : array
+        the volume, voxel i covers the coordinates [i, i+1)
+    coords : array (m, 3)
+        the coordinates in voxel units
+
+    Returns
+    -------
+    (val, inside) : arrays (m,)
+        the interpolated values and a mask of the coordinates inside the volume
+
+    """
+    shape = np.array(data.shape[:3])
+    inside = ((coords >= 0) & (coords < shape)).all(axis = 1)
+
+    # the values are given at the voxel centers, the border half voxels
+    # take the values of the border voxels
+    x = np.clip(coords - 0.5, 0, shape - 1)
+    i0 = np.minimum(np.floor(x).astype(np.intp), np.maximum(shape - 2, 0))
+    i1 = np.minimum(i0 + 1, shape - 1)
+    f = x - i0
+
+    val = np.zeros(len(coords))
+    for cx in (0, 1):
+        wx = f[:,0] if cx else 1 - f[:,0]
+        ix = i1[:,0] if cx else i0[:,0]
+        for cy in (0, 1):
+            wy = f[:,1] if cy else 1 - f[:,1]
+            iy = i1[:,1] if cy else i0[:,1]
+            for cz in (0, 1):
+                wz = f[:,2] if cz else 1 - f[:,2]
+                iz = i1[:,2] if cz else i0[:,2]
+                val += wx * wy * wz * data[ix, iy, iz]
+
+    return (val, inside)
+
+def tract_profiles_packed(points, offsets, volumes, nodes):
+    """ Profiles of scalar volumes along packed fibers
+
+    Every fiber is resampled to nodes points equidistant along the fiber,
+    and the volumes are trilinearly interpolated at these points.
+
+    Parameters
+    ----------
+    points : array (N, 3)
+        the points of the fibers in milimeter, one fiber after the other
+    offsets : array (n+1,)
+        the points of fiber i are points[offsets[i]:offsets[i+1]]
+    volumes : list
+        the (data, zooms) of each scalar volume
+    nodes : int
+        number of points of the profiles
+
+    Returns
+    -------
+    profiles : array (n, nodes, len(volumes))
+        the profiles from the first to the last point of each fiber, nan if
+        the fiber leaves the volume
+
+    """
+    n = len(offsets) - 1
+    pos = resample_packed(points, offsets, nodes).reshape( (-1, 3) )
+    profiles = np.empty( (n, nodes, len(volumes)), dtype = np.float32 )
+    for m, (data, zooms) in enumerate(volumes):
+        (val, inside) = interpolate_trilinear(data, pos / np.asarray(zooms[:3], dtype = np.float64))
+        val = val.reshape( (n, nodes) )
+        val[~inside.reshape( (n, nodes) ).all(axis = 1)] = np.nan
+        profiles[:,:,m] = val
+    return profiles
+
+def edge_profile_mean(fib, volumes, nodes, flip, bounds):
+    """ Mean profile of the fibers of each edge
+
+    The profiles are computed chunk by chunk and summed per edge, the
+    profiles of all fibers are never held at once.
+
+    Parameters
+    ----------
+    fib : PackedFibers
+        the fibers ordered by edge
+    volumes : list
+        the (data, zooms) of each scalar volume
+    nodes : int
+        number of points of the profiles
+    flip : array (m,)
+        mask of the profiles to reverse before averaging
+    bounds : array (e+1,)
+        the fibers of edge k are fib[bounds[k]:bounds[k+1]], edges must not be
+        empty
+
+    Returns
+    -------
+    mean : array (e, nodes, len(volumes))
+        the mean profiles, the nan of fibers leaving a volume are left out
+
+    """
+    e = len(bounds) - 1
+    if e < 1:
+        return np.zeros( (0, nodes, len(volumes)), dtype = np.float32 )
+
+    k = nodes * len(volumes)
+    total = np.zeros(e * k)
+    count = np.zeros(e * k)
+    edge = np.repeat(np.arange(e), np.diff(bounds))
+    cell = np.arange(k)
+    for a, b, points, offsets in fib.iter_packed():
+        profiles = tract_profiles_packed(points, offsets, volumes, nodes)
+        profiles = np.where(flip[a:b,None,None], profiles[:,::-1], profiles).reshape( (b - a, k) )
+        valid = ~np.isnan(profiles)
+        idx = (edge[a:b,None] * k + cell)[valid]
+        total += np.bincount(idx, weights = profiles[valid], minlength = e * k)
+        count += np.bincount(idx, minlength = e * k)
+
+    mean = np.empty(e * k, dtype = np.float32)
+    mean.fill(np.nan)
+    mean[count > 0] = total[count > 0] / count[count > 0]
+    return mean.reshape( (e, nodes, len(volumes)) )
+
+def cached_fiber_arrays(intrk, digest, key, names, compute):
+    """ Returns the arrays names derived from the fibers of intrk, from the
+    cache of its content digest under key if they are cached there, or as
+    computed by compute() otherwise """
+
+    cached = fiberstore.load_cached(intrk, digest, key, names)
+    if not cached is None:
+        log.info("Reuse the cached %s of %s" % (', '.join(names), intrk))
+        return [cached[k] for k in names]
+
+    arrays = compute()
+    fiberstore.store_cached(intrk, digest, key, dict(zip(names, arrays)))
+    return arrays
 
 def cmat(): 
-    """ Create the connection matrix for each resolution using fibers and ROIs. """
+    """ Create the connection matrix for each resolution using fibers and ROIs.
+
+    With more than one process the resolutions are computed by the workers of
+    a multiprocessing pool, which inherit the inputs in `shared` by fork. This
+    only works where multiprocessing forks its workers (Unix). The workers
+    only read these arrays, so their pages stay shared copy-on-write. """
               
     # create the endpoints for each fibers
     en_fname  = op.join(gconf.get_cmp_fibers(), 'endpoints.npy')
@@ -117,7 +476,7 @@ def cmat():
     curv_fname  = op.join(gconf.get_cmp_fibers(), 'meancurvature.npy')
     intrk = op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk')
 
-    fib, hdr    = nibabel.trackvis.read(intrk, False)
+    fib = fiberstore.load_packed(intrk, log = log)
     
     # Previously, load_endpoints_from_trk() used the voxel size stored
     # in the track hdr to transform the endpoints to ROI voxel space.
@@ -131,217 +490,196 @@ def cmat():
                            'ROI_HR_th.nii.gz')
     firstROI = nibabel.load(firstROIFile)
     roiVoxelSize = firstROI.get_header().get_zooms()
-    (endpoints,endpointsmm) = create_endpoints_array(fib, roiVoxelSize)
+
+    # the fiber arrays are cached for the content of the track file, so
+    # that adding a resolution does not compute them again
+    digest = fiberstore.track_digest(intrk)
+    voxelkey = 'voxelsize_%s' % '_'.join(['%g' % z for z in roiVoxelSize[:3]])
+    (endpoints,endpointsmm) = cached_fiber_arrays(intrk, digest, voxelkey, ['endpoints', 'endpointsmm'],
+                                                  lambda: create_endpoints_array(fib, roiVoxelSize))
     np.save(en_fname, endpoints)
     np.save(en_fnamemm, endpointsmm)
 
     # only compute curvature if required
     if gconf.compute_curvature:
-        meancurv = compute_curvature_array(fib)
+        (meancurv,) = cached_fiber_arrays(intrk, digest, 'fibers', ['meancurvature'],
+                                          lambda: (compute_curvature_array(fib),))
         np.save(curv_fname, meancurv)
+
+    (lengths,) = cached_fiber_arrays(intrk, digest, 'fibers', ['lengths'],
+                                     lambda: (fib.map_packed(length_packed),))
     
     log.info("========================")
     
-    n = len(fib)
-    
-    resolution = gconf.parcellation.keys()
+    # sample the scalar volumes along all fibers once, the resolutions
+    # only reduce the per fiber sums over their edges
+    scalars = {}
+    volumes = {}
+    for k,v in get_measure_files().items():
+        log.info("Sample volume %s along the fibers" % v)
+        da = nibabel.load( op.join(gconf.get_cmp_scalars(), v) )
+        volumes[k] = (da.get_data(), da.get_header().get_zooms())
+        scalars[k] = sample_scalar_volume(fib, volumes[k][0], volumes[k][1])
+        if scalars[k][2].any():
+            log.info("Found %i fibers with points outside of volume %s. Discard them for measure %s." % (scalars[k][2].sum(), v, k))
+
+    # the volumes of the along tract profiles, the resolutions compute the
+    # profiles of the fibers of their edges
+    profile_measures = sorted(volumes.keys())
+    profile_volumes = None
+    if gconf.compute_tract_profiles and len(profile_measures) > 0:
+        profile_volumes = [volumes[k] for k in profile_measures]
+    del volumes
+
+    # prepare: the inputs shared read-only by all resolutions
+    shared.clear()
+    shared.update({ 'intrk' : intrk, 'endpoints' : endpoints,
+                    'lengths' : lengths,
+                    'npoints' : fib.number_of_points(), 'scalars' : scalars,
+                    'fib' : fib, 'profile_volumes' : profile_volumes,
+                    'profile_measures' : profile_measures })
 
-    for r in resolution:
-        
-        log.info("Resolution = "+r)
-        
-        # create empty fiber label array
-        fiberlabels = np.zeros( (n, 2) )
-        final_fiberlabels = []
-        final_fibers_idx = []
-        
-        # Open the corresponding ROI
-        log.info("Open the corresponding ROI")
-        roi_fname = op.join(gconf.get_cmp_tracto_mask_tob0(), r, 'ROI_HR_th.nii.gz')
-        roi       = nibabel.load(roi_fname)
-        roiData   = roi.get_data()
-      
-        # Create the matrix
-        nROIs = gconf.parcellation[r]['number_of_regions']
-        log.info("Create the connection matrix (%s rois)" % nROIs)
-        G     = nx.Graph()
-
-        # add node information from parcellation
-        gp = nx.read_graphml(gconf.parcellation[r]['node_information_graphml'])
-        for u,d in gp.nodes_iter(data=True):
-            G.add_node(int(u), d)
-            # compute a position for the node based on the mean position of the
-            # ROI in voxel coordinates (segmentation volume )
-            G.node[int(u)]['dn_position'] = str(tuple(np.mean( np.where(roiData== int(d["dn_correspondence_id"]) ) , axis = 1)))
-
-        dis = 0
-
-        # prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype = np.object )
-        if gconf.diffusion_imaging_model == 'DSI':
-            mmap = {}
-            if gconf.connection_P0:
-                mmap['P0'] = 'dsi_P0.nii.gz'
-            if gconf.connection_gfa:
-                mmap['gfa'] = 'dsi_gfa.nii.gz'
-            if gconf.connection_kurtosis:
-                mmap['kurtosis'] = 'dsi_kurtosis.nii.gz'
-            if gconf.connection_skewness:
-                mmap['skewness'] = 'dsi_skewness.nii.gz'
-            mmapdata = {}
-            for k,v in mmap.items():
-                da = nibabel.load( op.join(gconf.get_cmp_scalars(), v) )
-                mmapdata[k] = (da.get_data(), da.get_header().get_zooms() )
-
-        elif gconf.diffusion_imaging_model == 'DTI':
-            mmap = {}
-            if gconf.connection_adc:
-                mmap['adc'] = 'dti_adc.nii.gz'
-            if gconf.connection_fa:
-                mmap['fa'] = 'dti_fa.nii.gz'
-            mmapdata = {}
-            for k,v in mmap.items():
-                print "Read volume", v
-                da = nibabel.load( op.join(gconf.get_cmp_scalars(), v) )
-                mmapdata[k] = (da.get_data(), da.get_header().get_zooms() )
-
-        elif gconf.diffusion_imaging_model == 'QBALL':
-            mmap = {}
-            if gconf.connection_P0:
-                mmap['P0'] = 'hardi_P0.nii.gz'
-            if gconf.connection_gfa:
-                mmap['gfa'] = 'hardi_gfa.nii.gz'
-            if gconf.connection_kurtosis:
-                mmap['kurtosis'] = 'hardi_kurtosis.nii.gz'
-            if gconf.connection_skewness:
-                mmap['skewness'] = 'hardi_skewness.nii.gz'
-            mmapdata = {}
-            for k,v in mmap.items():
-                da = nibabel.load( op.join(gconf.get_cmp_scalars(), v) )
-                mmapdata[k] = (da.get_data(), da.get_header().get_zooms() )
-
-        log.info("Create the connection matrix")
-        pc = -1
-        for i in range(n):
-
-            # Percent counter
-            pcN = int(round( float(100*i)/n ))
-            if pcN > pc and pcN%1 == 0:
-                pc = pcN
-                log.info('%4.0f%%' % (pc))
-
-            # ROI start => ROI end
-            try:
-                startROI = int(roiData[endpoints[i, 0, 0], endpoints[i, 0, 1], endpoints[i, 0, 2]])
-                endROI   = int(roiData[endpoints[i, 1, 0], endpoints[i, 1, 1], endpoints[i, 1, 2]])
-            except IndexError:
-                log.info("An index error occured for fiber %s. This means that the fiber start or endpoint is outside the volume. Continue." % i)
-                continue
-            
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i,0] = -1
-                continue
-            
-            if startROI > nROIs or endROI > nROIs:
-                log.debug("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                log.debug("than is expected by the parcellation node information.")
-                log.debug("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                log.debug("This needs bugfixing!")
-                continue
-            
-            # Update fiber label
-            # switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-
-            fiberlabels[i,0] = startROI
-            fiberlabels[i,1] = endROI
-
-            final_fiberlabels.append( [ startROI, endROI ] )
-            final_fibers_idx.append(i)
-
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G.edge[startROI][endROI]['fiblist'].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist = [i])
-                
-        log.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis*100.0/n, n) )
-        log.info("Valid fibers: %i (%f percent)" % (n-dis, 100 - dis*100.0/n) )
-
-        # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            finalfiberlength.append( length(fib[idx][0]) )
-
-        # convert to array
-        final_fiberlength_array = np.array( finalfiberlength )
-        
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype = np.int32)
-
-        # update edges
-        # measures to add here
-        for u,v,d in G.edges_iter(data=True):
-            # print "From To Region ", u,v
-            G.remove_edge(u,v)
-            di = { 'number_of_fibers' : len(d['fiblist']), }
-
-            idx = np.where( (final_fiberlabels_array[:,0] == int(u)) & (final_fiberlabels_array[:,1] == int(v)) )[0]
-            di['fiber_length_mean'] = float( np.mean(final_fiberlength_array[idx]) )
-            di['fiber_length_std'] = float( np.std(final_fiberlength_array[idx]) )
-
-            # this is indexed into the fibers that are valid in the sense of touching start
-            # and end roi and not going out of the volume
-            idx_valid = np.where( (fiberlabels[:,0] == int(u)) & (fiberlabels[:,1] == int(v)) )[0]
-            for k,vv in mmapdata.items():
-                val = []
-                for i in idx_valid:
-                    # retrieve indices
-                    try:
-                        idx2 = (h[i]/ vv[1] ).astype( np.uint32 )
-                        val.append( vv[0][idx2[:,0],idx2[:,1],idx2[:,2]] )
-                    except IndexError, e:
-                        print "Index error occured when trying extract scalar values for measure", k
-                        print "--> Discard fiber with index", i, "Exception: ", e
-                        print "----"
-
-                da = np.concatenate( val )
-                di[k + '_mean'] = float(da.mean())
-                di[k + '_std'] = float(da.std())
-                del da
-                del val
-
-            G.add_edge(u,v, di)
-
-        # storing network
-        nx.write_gpickle(G, op.join(gconf.get_cmp_matrices(), 'connectome_%s.gpickle' % r))
-
-        log.info("Storing final fiber length array")
-        fiberlabels_fname  = op.join(gconf.get_cmp_fibers(), 'final_fiberslength_%s.npy' % str(r))
-        np.save(fiberlabels_fname, final_fiberlength_array)
-
-        log.info("Storing all fiber labels (with orphans)")
-        fiberlabels_fname  = op.join(gconf.get_cmp_fibers(), 'filtered_fiberslabel_%s.npy' % str(r))
-        np.save(fiberlabels_fname, np.array(fiberlabels, dtype = np.int32), )
-
-        log.info("Storing final fiber labels (no orphans)")
-        fiberlabels_noorphans_fname  = op.join(gconf.get_cmp_fibers(), 'final_fiberlabels_%s.npy' % str(r))
-        np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
-
-        log.info("Filtering tractography - keeping only no orphan fibers")
-        finalfibers_fname = op.join(gconf.get_cmp_fibers(), 'streamline_final_%s.trk' % str(r))
-        save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+    resolution = gconf.parcellation.keys()
+    nproc = min(gconf.connectome_processes, len(resolution))
+
+    if nproc > 1:
+        # the workers are forked and inherit the shared inputs, only the
+        # resolution names are passed to them
+        log.info("Create the connection matrices with %i processes" % nproc)
+        pool = multiprocessing.Pool(processes = nproc)
+        try:
+            pool.map(cmat_resolution, resolution)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for r in resolution:
+            cmat_resolution(r)
+
+    shared.clear()
 
     log.info("Done.")
     log.info("========================")
 
+def cmat_resolution(r):
+    """ Create and store the connection matrix of resolution r from the inputs
+    prepared by cmat() """
+
+    endpoints = shared['endpoints']
+    npoints = shared['npoints']
+    n = endpoints.shape[0]
+
+    log.info("Resolution = "+r)
+
+    # Open the corresponding ROI
+    log.info("Open the corresponding ROI")
+    roi_fname = op.join(gconf.get_cmp_tracto_mask_tob0(), r, 'ROI_HR_th.nii.gz')
+    roi       = nibabel.load(roi_fname)
+    roiData   = roi.get_data()
+
+    # Create the matrix
+    nROIs = gconf.parcellation[r]['number_of_regions']
+    log.info("Create the connection matrix (%s rois)" % nROIs)
+    G     = nx.Graph()
+
+    # add node information from parcellation
+    gp = nx.read_graphml(gconf.parcellation[r]['node_information_graphml'])
+    # the centroids of all ROIs, computed in a single pass over the volume
+    centroids = label_centroids(roiData)
+    for u,d in gp.nodes_iter(data=True):
+        G.add_node(int(u), d)
+        # compute a position for the node based on the mean position of the
+        # ROI in voxel coordinates (segmentation volume )
+        cid = int(d["dn_correspondence_id"])
+        if cid < len(centroids):
+            G.node[int(u)]['dn_position'] = str(tuple(centroids[cid]))
+        else:
+            G.node[int(u)]['dn_position'] = str(tuple(centroids[0] * np.nan))
+
+    log.info("Create the connection matrix")
+    (fiberlabels, final_fibers_idx, outside, orphans) = label_fibers(endpoints, roiData, nROIs)
+
+    if outside.any():
+        log.info("Found %i fibers with a start or endpoint outside the volume. Discard them." % outside.sum())
+
+    dis = int(orphans.sum())
+    log.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis*100.0/n, n) )
+    log.info("Valid fibers: %i (%f percent)" % (n-dis, 100 - dis*100.0/n) )
+
+    # make final fiber labels as array
+    final_fiberlabels_array = fiberlabels[final_fibers_idx]
+
+    # group the fibers by label pair, each edge is a contiguous segment
+    (edges, order, bounds) = group_fibers_by_edge(final_fiberlabels_array)
+    fibers_by_edge = final_fibers_idx[order]
+    number_of_fibers = np.diff(bounds)
+
+    # create a final fiber length array
+    final_fiberlength_array = shared['lengths'][final_fibers_idx]
+
+    # measures to add here
+    (length_mean, length_std) = grouped_mean_std(final_fiberlength_array[order], bounds)
+
+    measures = {}
+    for k,(sums, sumsq, discard) in shared['scalars'].items():
+        # the fibers with points outside of the volume do not contribute
+        keep = ~discard[fibers_by_edge]
+        measures[k] = grouped_scalar_mean_std(sums[fibers_by_edge] * keep,
+                                              sumsq[fibers_by_edge] * keep,
+                                              npoints[fibers_by_edge] * keep, bounds)
+
+    # the mean profile of each edge, from its first to its second node
+    if not shared['profile_volumes'] is None:
+        log.info("Compute the tract profiles of %s with %i nodes" % (', '.join(shared['profile_measures']), gconf.tract_profile_nodes))
+        ep = endpoints[fibers_by_edge].astype(np.intp)
+        flip = roiData[ep[:,0,0], ep[:,0,1], ep[:,0,2]] > roiData[ep[:,1,0], ep[:,1,1], ep[:,1,2]]
+        edge_profiles = edge_profile_mean(shared['fib'].subset(fibers_by_edge), shared['profile_volumes'],
+                                          gconf.tract_profile_nodes, flip, bounds)
+        log.info("Storing the tract profiles")
+        np.savez(op.join(gconf.get_cmp_matrices(), 'connectome_%s_profiles.npz' % r),
+                 profiles = edge_profiles, edges = edges,
+                 measures = np.array(shared['profile_measures']))
+
+    # the edge measures
+    edge_measures = { 'number_of_fibers' : number_of_fibers,
+                      'fiber_length_mean' : length_mean,
+                      'fiber_length_std' : length_std }
+    for k in measures.keys():
+        edge_measures[k + '_mean'] = measures[k][0]
+        edge_measures[k + '_std'] = measures[k][1]
+
+    # add the edges with their measures
+    for e in range(edges.shape[0]):
+        di = { 'number_of_fibers' : int(number_of_fibers[e]), }
+        for k in edge_measures.keys():
+            if k != 'number_of_fibers':
+                di[k] = float( edge_measures[k][e] )
+
+        G.add_edge(int(edges[e,0]), int(edges[e,1]), di)
+
+    # storing network
+    nx.write_gpickle(G, op.join(gconf.get_cmp_matrices(), 'connectome_%s.gpickle' % r))
+
+    # and its edge measures as sparse matrices
+    save_sparse_connectome(op.join(gconf.get_cmp_matrices(), 'connectome_%s_matrices.npz' % r),
+                           sorted(G.nodes()), edges, edge_measures)
+
+    log.info("Storing final fiber length array")
+    fiberlabels_fname  = op.join(gconf.get_cmp_fibers(), 'final_fiberslength_%s.npy' % str(r))
+    np.save(fiberlabels_fname, final_fiberlength_array)
+
+    log.info("Storing all fiber labels (with orphans)")
+    fiberlabels_fname  = op.join(gconf.get_cmp_fibers(), 'filtered_fiberslabel_%s.npy' % str(r))
+    np.save(fiberlabels_fname, fiberlabels)
+
+    log.info("Storing final fiber labels (no orphans)")
+    fiberlabels_noorphans_fname  = op.join(gconf.get_cmp_fibers(), 'final_fiberlabels_%s.npy' % str(r))
+    np.save(fiberlabels_noorphans_fname, final_fiberlabels_array)
+
+    log.info("Filtering tractography - keeping only no orphan fibers")
+    finalfibers_fname = op.join(gconf.get_cmp_fibers(), 'streamline_final_%s.trk' % str(r))
+    save_fibers(shared['intrk'], finalfibers_fname, final_fibers_idx)
+
 def inspect(gconf):
     """ Inspect the results of this stage """
     log = gconf.get_logger()
@@ -349,9 +687,6 @@ def inspect(gconf):
     # display matrices with matplotlib if available
     # the same script as used in connectome viewer
 
-    # Importing NetworkX
-    import networkx as nx
-
     # Import Pylab
     try:
         from cmp.util import show_matrix
@@ -362,8 +697,13 @@ def inspect(gconf):
     resolution = gconf.parcellation.keys()
 
     for r in resolution:
-        # retrieve the graph
-        g=nx.read_gpickle(op.join(gconf.get_cmp_matrices(), 'connectome_%s.gpickle' % r))
+        # retrieve the matrices, the subjects processed before the matrix
+        # bundles were written only have the graph
+        fname = op.join(gconf.get_cmp_matrices(), 'connectome_%s_matrices.npz' % r)
+        if op.exists(fname):
+            g = load_sparse_connectome(fname)
+        else:
+            g = nx.read_gpickle(op.join(gconf.get_cmp_matrices(), 'connectome_%s.gpickle' % r))
         show_matrix(g, "number_of_fibers", True)
 
 
@@ -392,6 +732,10 @@ def run(conf):
         send_email_notification(msg, gconf, log)  
         
 
+def required_cpus(conf):
+    """ Number of cpus used by this stage: the resolutions processed in parallel """
+    return conf.connectome_processes
+
 def declare_inputs(conf):
     """Declare the inputs to the stage to the PipelineStatus object"""
     
@@ -414,9 +758,13 @@ def declare_outputs(conf):
     resolution = conf.parcellation.keys()
     for r in resolution:
         conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_matrices(), 'connectome_%s.gpickle' % r, 'connectome_%s-gpickle')
+        conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_matrices(), 'connectome_%s_matrices.npz' % r, 'connectome_%s_matrices-npz' % r)
         conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_fibers(), 'final_fiberslength_%s.npy' % str(r), 'final_fiberslength_%s-npy' % str(r))
         conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_fibers(), 'filtered_fiberslabel_%s.npy' % str(r), 'filtered_fiberslabel_%s-npy' % str(r))
         conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_fibers(), 'final_fiberlabels_%s.npy' % str(r), 'fiberlabels_%s-npy' % str(r))
         conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_fibers(), 'streamline_final_%s.trk' % str(r), 'streamline_final_%s-trk' % str(r))
+        # as in cmat(), the profiles are only stored for enabled measures
+        if conf.compute_tract_profiles and len(get_measure_files(conf)) > 0:
+            conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_matrices(), 'connectome_%s_profiles.npz' % str(r), 'connectome_%s_profiles-npz' % str(r))
         
         
\ No newline at end of file
@@ -304,11 +304,25 @@ def add_surfaces2connectome(connectome):
     
     fs_dir = gconf.get_fs()
     
+    # the labels to convert
+    lilab = ['lh.aparc.annot', 'rh.aparc.annot']
+    # corresponding surface to use
+    corsurf = ['lh.pial', 'rh.pial']
+
+    # the conversions are independent, run several at once. A surface which
+    # could not be converted is left out, so all conversions are tried
+    cmds = []
+    for i in li:
+        outfile = op.join(fs_dir, 'surf', i+'.gii')
+        cmds.append( 'mris_convert %s %s' % (op.join(fs_dir, 'surf', i), outfile) )
+    for idx, i in enumerate(lilab):
+        outfile = op.join(fs_dir, 'label', i+'.gii')
+        # mris_convert --annot lh.aparc.annot ../surf/lh.pial lh.aparc.annot.gifti
+        cmds.append( 'mris_convert --annot %s %s %s' % (op.join(fs_dir, 'label', i), op.join(fs_dir, 'surf', corsurf[idx]), outfile) )
+    runCmds( cmds, log, gconf.command_processes, fail_fast = False )
+
     for i in li:
         outfile = op.join(fs_dir, 'surf', i+'.gii')
-        cmd = 'mris_convert %s %s' % (op.join(fs_dir, 'surf', i), outfile)
-        runCmd( cmd, log )
-    
         if op.exists(outfile):
             csur = cf.CSurface(name="Surface %s" % i,
                            src=outfile,
@@ -317,16 +331,9 @@ def add_surfaces2connectome(connectome):
             
             connectome.add_connectome_surface(csur)
 
-    # convert label and add
-    lilab = ['lh.aparc.annot', 'rh.aparc.annot']
-    # corresponding surface to use
-    corsurf = ['lh.pial', 'rh.pial']
-    for idx, i in enumerate(lilab):
+    # add the labels
+    for i in lilab:
         outfile = op.join(fs_dir, 'label', i+'.gii')
-        cmd = 'mris_convert --annot %s %s %s' % (op.join(fs_dir, 'label', i), op.join(fs_dir, 'surf', corsurf[idx]), outfile)
-        runCmd( cmd, log )
-
-        # mris_convert --annot lh.aparc.annot ../surf/lh.pial lh.aparc.annot.gifti
         if op.exists(outfile):
             csur = cf.CSurface(name="Surface Label %s" % i,
                            src=outfile,
@@ -455,14 +462,45 @@ def run(conf):
         msg = ["CFF Converter", int(time()-start)]
         send_email_notification(msg, gconf, log)
         
+def required_cpus(conf):
+    """ Number of cpus used by this stage: the external commands run at once """
+    return conf.command_processes
+
 def declare_inputs(conf):
     """Declare the inputs to the stage to the PipelineStatus object"""
     
     stage = conf.pipeline_status.GetStage(__name__)
     
-    # conf.pipeline_status.AddStageInput(stage, conf.get_cmp_matrices(), 'cmat.pickle', 'cmat-pickle')
-        
-    
+    # the files bundled into the connectome file, under the same options as
+    # in convert2cff(). They order this stage after the stages producing
+    # them. The files which are added only if they exist, e.g. those of the ROI
+    # segmentation, are not required
+    fibers_path = conf.get_cmp_fibers()
+    resolution = conf.parcellation.keys()
+    if conf.cff_fullnetworkpickle:
+        for r in resolution:
+            conf.pipeline_status.AddStageInput(stage, conf.get_cmp_matrices(), 'connectome_%s.gpickle' % r, 'connectome_%s-gpickle' % r)
+
+    if conf.cff_originalfibers:
+        conf.pipeline_status.AddStageInput(stage, fibers_path, 'streamline.trk', 'streamline-trk')
+
+    if conf.cff_filteredfibers:
+        conf.pipeline_status.AddStageInput(stage, fibers_path, 'streamline_filtered.trk', 'streamline_filtered-trk')
+
+    if conf.cff_finalfiberlabels:
+        for r in resolution:
+            conf.pipeline_status.AddStageInput(stage, fibers_path, 'final_fiberlabels_%s.npy' % str(r), 'fiberlabels_%s-npy' % str(r))
+            conf.pipeline_status.AddStageInput(stage, fibers_path, 'streamline_final_%s.trk' % str(r), 'streamline_final_%s-trk' % str(r))
+            conf.pipeline_status.AddStageInput(stage, fibers_path, 'final_fiberslength_%s.npy' % str(r), 'final_fiberslength_%s-npy' % str(r))
+
+    if conf.cff_fiberarr:
+        conf.pipeline_status.AddStageInput(stage, fibers_path, 'lengths.npy', 'lengths-npy')
+        conf.pipeline_status.AddStageInput(stage, fibers_path, 'endpoints.npy', 'endpoints-npy')
+        conf.pipeline_status.AddStageInput(stage, fibers_path, 'endpointsmm.npy', 'endpointsmm-npy')
+        for r in resolution:
+            conf.pipeline_status.AddStageInput(stage, fibers_path, 'filtered_fiberslabel_%s.npy' % str(r), 'filtered_fiberslabel_%s-npy' % str(r))
+
+
 def declare_outputs(conf):
     """Declare the outputs to the stage to the PipelineStatus object"""
     
@@ -10,6 +10,7 @@ from time import time
 import shutil
 import subprocess
 import sys
+import multiprocessing
 from ...logme import *
 
 import nibabel as ni
@@ -17,6 +18,25 @@ import networkx as nx
 import numpy as np
 from cmp.util import mymove
 
+# read-only inputs of the parcellation scale workers, set up before they
+# are forked
+shared = {}
+
+def map_scales(func, scales):
+    """ Returns the results of func for each parcellation scale, computed in
+    parallel by gconf.parcellation_processes forked workers which inherit
+    the shared inputs """
+    nproc = min(gconf.parcellation_processes, len(scales))
+    if nproc > 1:
+        log.info("Process the parcellation scales with %i processes" % nproc)
+        pool = multiprocessing.Pool(processes = nproc)
+        try:
+            return pool.map(func, scales)
+        finally:
+            pool.close()
+            pool.join()
+    return [func(s) for s in scales]
+
 def create_annot_label():
 
     log.info("Create the cortical labels necessary for our ROIs")
@@ -95,86 +115,220 @@ def create_annot_label():
 
     log.info("[ DONE ]")  
 
-def create_roi():
+def read_label(fname):
+    """ Returns the vertex numbers and the surface RAS coordinates (n,3) of
+    the points of a FreeSurfer .label file """
+    f = open(fname)
+    f.readline()
+    n = int(f.readline())
+    data = np.fromstring(f.read(), sep = ' ').reshape( (n, 5) )
+    f.close()
+    return data[:,0].astype(np.int32), data[:,1:4]
+
+def tkr_ras2vox(affine, shape):
+    """ Returns the transformation from the surface RAS coordinates of the
+    FreeSurfer surfaces and labels (tkregister RAS) to the voxels of a volume
+    with affine and shape, as used by mri_label2vol --identity """
+    M = affine[:3,:3]
+    vox2ras = np.eye(4)
+    vox2ras[:3,:3] = M
+    vox2ras[:3,3] = -np.dot(M, np.array(shape[:3]) / 2.0)
+    return np.linalg.inv(vox2ras)
+
+def label_voxels(fnames, ras2vox, shape):
+    """ Returns for each label file the index (i, j, k) of the voxels it
+    fills, the points of all labels are mapped to voxels at once.
+
+    As mri_label2vol with the default fill threshold, a voxel belongs to a
+    label if any of the label points falls in it. Points outside of the
+    volume are dropped.
+    """
+    coords = []
+    counts = []
+    for fname in fnames:
+        vno, xyz = read_label(fname)
+        coords.append(xyz)
+        counts.append(len(xyz))
+    if len(coords) == 0:
+        return []
+    coords = np.concatenate(coords)
+    # nearest voxel, halfway points are rounded up as by FreeSurfer
+    ijk = np.floor( np.dot(coords, ras2vox[:3,:3].T) + ras2vox[:3,3] + 0.5 ).astype(np.int32)
+    inside = np.all( (ijk >= 0) & (ijk < np.array(shape[:3])), axis = 1 )
+    offsets = np.concatenate( ([0], np.cumsum(counts)) )
+    index = []
+    for i in range(len(counts)):
+        v = ijk[offsets[i]:offsets[i+1]][inside[offsets[i]:offsets[i+1]]]
+        index.append( (v[:,0], v[:,1], v[:,2]) )
+    return index
+
+def label2vol_voxels(fname, labelpath):
+    """ Returns the index (i, j, k) of the voxels of the label file fname in
+    orig.mgz, rasterized by mri_label2vol --identity into a temporary file
+    in labelpath """
+    tmp_file = op.join(labelpath, 'tmp.nii.gz')
+    mri_cmd = 'mri_label2vol --label "%s" --temp "%s" --o "%s" --identity' % (fname,
+            op.join(gconf.get_fs(), 'mri', 'orig.mgz'), tmp_file)
+    runCmd( mri_cmd, log )
+    
+    tmp = ni.load(tmp_file)
+    tmpd = tmp.get_data()
+    return np.where(tmpd == 1)
+
+def create_roi(aseg):
     """ Creates the ROI_%s.nii.gz files using the given parcellation information
     from networks. Iteratively create volume. """
     
     log.info("Create the ROIs:")
     fs_dir = gconf.get_fs()
     
-    # load aseg volume
-    aseg = ni.load(op.join(fs_dir, 'mri', 'aseg.nii.gz'))
+    # the aseg volume is shared by all scales
     asegd = aseg.get_data()
+    shared.clear()
+    # aseg has the geometry of orig.mgz
+    shared.update({ 'aseg' : aseg, 'asegd' : asegd,
+                    'ras2vox' : tkr_ras2vox(aseg.get_affine(), asegd.shape) })
+
+    map_scales(create_roi_scale, gconf.parcellation.keys())
+    shared.clear()
     
-    for parkey, parval in gconf.parcellation.items():
-        log.info("Working on parcellation: " + parkey)
-        log.info("========================")
-        pg = nx.read_graphml(parval['node_information_graphml'])
-        
-        # each node represents a brain region
-        # create a big 256^3 volume for storage of all ROIs
-        rois = np.zeros( (256, 256, 256), dtype=np.int16 )
+    log.info("[ DONE ]")  
+
+def create_roi_scale(parkey):
+    """ Creates the ROI_%s.nii.gz file of the parcellation scale parkey from
+    the inputs prepared by create_roi() """
+    fs_dir = gconf.get_fs()
+    parval = gconf.parcellation[parkey]
+    aseg = shared['aseg']
+    asegd = shared['asegd']
+
+    log.info("Working on parcellation: " + parkey)
+    log.info("========================")
+    pg = nx.read_graphml(parval['node_information_graphml'])
+    
+    # each node represents a brain region
+    # create a big 256^3 volume for storage of all ROIs
+    rois = np.zeros( (256, 256, 256), dtype=np.int16 )
+
+    # map the label points of the cortical regions of each hemisphere to
+    # voxels of orig.mgz in one pass, else each label is rasterized by
+    # mri_label2vol
+    voxels = {}
+    if gconf.native_label_rasterization:
+        for hemi, side in [('lh', 'left'), ('rh', 'right')]:
+            nodes = [brk for brk, brv in pg.nodes_iter(data=True) if brv['dn_region'] == 'cortical' and brv['dn_hemisphere'] == side]
+            labelpath = op.join(fs_dir, 'label', parval['fs_label_subdir_name'] % hemi)
+            fnames = [op.join(labelpath, '%s.%s.label' % (hemi, pg.node[brk]['dn_fsname'])) for brk in nodes]
+            voxels.update( zip(nodes, label_voxels(fnames, shared['ras2vox'], rois.shape)) )
+    
+    for brk, brv in pg.nodes_iter(data=True):
         
-        for brk, brv in pg.nodes_iter(data=True):
+        if brv['dn_hemisphere'] == 'left':
+            hemi = 'lh'
+        elif brv['dn_hemisphere'] == 'right':
+            hemi = 'rh'
             
-            if brv['dn_hemisphere'] == 'left':
-                hemi = 'lh'
-            elif brv['dn_hemisphere'] == 'right':
-                hemi = 'rh'
-                
-            if brv['dn_region'] == 'subcortical':
-
-                log.info("---------------------")
-                log.info("Work on brain region: %s" % (brv['dn_region']) )
-                log.info("Freesurfer Name: %s" %  brv['dn_fsname'] )
-                log.info("---------------------")
-
-                # if it is subcortical, retrieve roi from aseg
-                idx = np.where(asegd == int(brv['dn_fs_aseg_val']))
-                rois[idx] = int(brv['dn_correspondence_id'])
-            
-            elif brv['dn_region'] == 'cortical':
-                log.info(brv)
-                log.info("---------------------")
-                log.info("Work on brain region: %s" % (brv['dn_region']) )
-                log.info("Freesurfer Name: %s" %  brv['dn_fsname'] )
-                log.info("---------------------")
+        if brv['dn_region'] == 'subcortical':
+
+            log.info("---------------------")
+            log.info("Work on brain region: %s" % (brv['dn_region']) )
+            log.info("Freesurfer Name: %s" %  brv['dn_fsname'] )
+            log.info("---------------------")
 
+            # if it is subcortical, retrieve roi from aseg
+            idx = np.where(asegd == int(brv['dn_fs_aseg_val']))
+            rois[idx] = int(brv['dn_correspondence_id'])
+        
+        elif brv['dn_region'] == 'cortical':
+            log.info(brv)
+            log.info("---------------------")
+            log.info("Work on brain region: %s" % (brv['dn_region']) )
+            log.info("Freesurfer Name: %s" %  brv['dn_fsname'] )
+            log.info("---------------------")
+
+            # voxels of the label file of the region
+            if not brk in voxels:
                 labelpath = op.join(fs_dir, 'label', parval['fs_label_subdir_name'] % hemi)
-                # construct .label file name
-                
                 fname = '%s.%s.label' % (hemi, brv['dn_fsname'])
+                voxels[brk] = label2vol_voxels(op.join(labelpath, fname), labelpath)
+            rois[voxels[brk]] = int(brv['dn_correspondence_id'])
+            
+                    
+    # store volume eg in ROI_scale33.nii.gz
+    out_roi = op.join(fs_dir, 'label', 'ROI_%s.nii.gz' % parkey)
+    # update the header
+    hdr = aseg.get_header()
+    hdr2 = hdr.copy()
+    hdr2.set_data_dtype(np.uint16)
+
+    log.info("Save output image to %s" % out_roi)
+    img = ni.Nifti1Image(rois, aseg.get_affine(), hdr2)
+    ni.save(img, out_roi)
+
+def relabel(data, mappings, dtype = np.uint8):
+    """ Map the labels of a volume with several mappings at once, using a
+    dense lookup table over the label values and one indexing of the volume
 
-                # execute fs mri_label2vol to generate volume roi from the label file
-                # store it in temporary file to be overwritten for each region
-
-                mri_cmd = 'mri_label2vol --label "%s" --temp "%s" --o "%s" --identity' % (op.join(labelpath, fname),
-                        op.join(fs_dir, 'mri', 'orig.mgz'), op.join(labelpath, 'tmp.nii.gz'))
-                runCmd( mri_cmd, log )
-                
-                tmp = ni.load(op.join(labelpath, 'tmp.nii.gz'))
-                tmpd = tmp.get_data()
-
-                # find voxel and set them to intensityvalue in rois
-                idx = np.where(tmpd == 1)
-                rois[idx] = int(brv['dn_correspondence_id'])
-                
-                        
-        # store volume eg in ROI_scale33.nii.gz
-        out_roi = op.join(fs_dir, 'label', 'ROI_%s.nii.gz' % parkey)
-        # update the header
-        hdr = aseg.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.uint16)
-
-        log.info("Save output image to %s" % out_roi)
-        img = ni.Nifti1Image(rois, aseg.get_affine(), hdr2)
-        ni.save(img, out_roi)
-    
-    log.info("[ DONE ]")  
-    
+    Parameters
+    ----------
+    data : array
+        volume of non-negative integer labels, e.g. aparc+aseg
+    mappings : list
+        each mapping is a list of [new, old] label pairs, the labels which are
+        not in a mapping are set to 0
+    dtype : numpy dtype
+        the type of the relabeled volumes
+
+    Returns
+    -------
+    volumes : list
+        the relabeled volume of each mapping
+
+    """
+    if not data.dtype.kind in 'iu':
+        data = data.astype(np.int32)
+    size = int(data.max()) + 1
+    lut = np.zeros( (size, len(mappings)), dtype = dtype )
+    for k, mapping in enumerate(mappings):
+        for new, old in mapping:
+            if old < size:
+                lut[old, k] = new
+    mapped = lut[data]
+    return [np.ascontiguousarray(mapped[..., k]) for k in range(len(mappings))]
+
+def erode_labels(labels, structure):
+    """ Binary erosion of every label of a volume in one pass
+
+    A voxel keeps its label if all its neighbours given by the structuring
+    element have the same label, the voxels outside of the volume count as
+    background. For each label this is the binary erosion of its mask.
 
-def create_wm_mask():
+    Parameters
+    ----------
+    labels : array
+        volume of integer labels, 0 is background
+    structure : array
+        the structuring element, centered at shape // 2
+
+    Returns
+    -------
+    eroded : array
+        the eroded labels
+
+    """
+    shape = np.array(labels.shape)
+    center = np.array(structure.shape) // 2
+    pad = np.maximum(center, np.array(structure.shape) - 1 - center)
+    padded = np.zeros( shape + 2 * pad, dtype = labels.dtype )
+    padded[ tuple([slice(p, p + n) for p, n in zip(pad, shape)]) ] = labels
+    keep = labels != 0
+    for o in np.argwhere(structure) - center:
+        keep &= padded[ tuple([slice(p + d, p + d + n) for p, d, n in zip(pad, o, shape)]) ] == labels
+    eroded = np.zeros_like(labels)
+    eroded[keep] = labels[keep]
+    return eroded
+
+def create_wm_mask(aseg):
     
     log.info("Create white matter mask")
     
@@ -186,33 +340,14 @@ def create_wm_mask():
     fsmask = ni.load(op.join(fs_dir, 'mri', 'ribbon.nii.gz'))
     fsmaskd = fsmask.get_data()
 
-    wmmask = np.zeros( fsmask.get_data().shape )
-    
     # these data is stored and could be extracted from fs_dir/stats/aseg.txt
     
     # extract right and left white matter 
-    idx_lh = np.where(fsmaskd == 120)
-    idx_rh = np.where(fsmaskd == 20)
-    
-    wmmask[idx_lh] = 1
-    wmmask[idx_rh] = 1
+    wmmask = relabel(fsmaskd, [ [[1, 120], [1, 20]] ])[0]
     
     # remove subcortical nuclei from white matter mask
-    aseg = ni.load(op.join(fs_dir, 'mri', 'aseg.nii.gz'))
     asegd = aseg.get_data()
 
-    try:
-        import scipy.ndimage.morphology as nd
-    except ImportError:
-        raise Exception('Need scipy for binary erosion of white matter mask')
-
-    # need binary erosion function
-    imerode = nd.binary_erosion
-    
-    # ventricle erosion    
-    csfA = np.zeros( asegd.shape )
-    csfB = np.zeros( asegd.shape )
-
     # structuring elements for erosion
     se1 = np.zeros( (3,3,5) )
     se1[1,:,2] = 1; se1[:,1,2] = 1; se1[1,1,:] = 1
@@ -221,79 +356,51 @@ def create_wm_mask():
 
     # lateral ventricles, thalamus proper and caudate
     # the latter two removed for better erosion, but put back afterwards
-    idx = np.where( (asegd == 4) |
-                    (asegd == 43) |
-                    (asegd == 11) |
-                    (asegd == 50) |
-                    (asegd == 31) |
-                    (asegd == 63) |
-                    (asegd == 10) |
-                    (asegd == 49) )
-    csfA[idx] = 1
-    csfA = imerode(imerode(csfA, se1),se)
-    
-    # thalmus proper and cuadate are put back because they are not lateral ventricles
-    idx = np.where( (asegd == 11) |
-                    (asegd == 50) |
-                    (asegd == 10) |
-                    (asegd == 49) )
-    csfA[idx] = 0
+    VENTRICLES = [4, 43, 11, 50, 31, 63, 10, 49]
+    PUTBACK = [11, 50, 10, 49]
 
     # REST CSF, IE 3RD AND 4TH VENTRICULE AND EXTRACEREBRAL CSF    
-    idx = np.where( (asegd == 5) |
-                    (asegd == 14) |
-                    (asegd == 15) |
-                    (asegd == 24) |
-                    (asegd == 44) |
-                    (asegd == 72) |
-                    (asegd == 75) |
-                    (asegd == 76) |
-                    (asegd == 213) |
-                    (asegd == 221))    
     # 43 ??, 4??  213?, 221?
     # more to discuss.
-    for i in [5,14,15,24,44,72,75,76,213,221]:
-        idx = np.where(asegd == i)
-        csfB[idx] = 1
-    
+    CSF = [5, 14, 15, 24, 44, 72, 75, 76, 213, 221]
+
     # do not remove the subthalamic nucleus for now from the wm mask
     # 23, 60
     # would stop the fiber going to the segmented "brainstem"
         
     # grey nuclei, either with or without erosion
-    gr_ncl = np.zeros( asegd.shape )
-    
-    # with erosion
-    for i in [10,11,12,49,50,51]:
-        idx = np.where(asegd == i)
-        # temporary volume
-        tmp = np.zeros( asegd.shape )
-        tmp[idx] = 1
-        tmp = imerode(tmp,se)
-        idx = np.where(tmp == 1)
-        gr_ncl[idx] = 1
-        
-    # without erosion
-    for i in [13,17,18,26,52,53,54,58]:
-        idx = np.where(asegd == i)
-        gr_ncl[idx] = 1
+    NUCLEI_ERODED = [10, 11, 12, 49, 50, 51]
+    NUCLEI = [13, 17, 18, 26, 52, 53, 54, 58]
 
     # remove remaining structure, e.g. brainstem
-    remaining = np.zeros( asegd.shape )
-    idx = np.where( asegd == 16 )
-    remaining[idx] = 1
-    
+    REMAINING = [16]
+
+    # the label sets of aseg, the nuclei to erode keep their label
+    csfA, putback, csfB, nuclei_eroded, nuclei, remaining = relabel(asegd, [
+        [[1, i] for i in VENTRICLES],
+        [[1, i] for i in PUTBACK],
+        [[1, i] for i in CSF],
+        [[i, i] for i in NUCLEI_ERODED],
+        [[1, i] for i in NUCLEI],
+        [[1, i] for i in REMAINING] ])
+
+    # ventricle erosion    
+    csfA = erode_labels(erode_labels(csfA, se1), se)
+    # thalmus proper and cuadate are put back because they are not lateral ventricles
+    csfA[putback != 0] = 0
+
+    # the nuclei are eroded each on their own
+    gr_ncl = (erode_labels(nuclei_eroded, se) != 0) | (nuclei != 0)
+
     # now remove all the structures from the white matter
-    idx = np.where( (csfA != 0) | (csfB != 0) | (gr_ncl != 0) | (remaining != 0) )
-    wmmask[idx] = 0
+    wmmask[ (csfA != 0) | (csfB != 0) | gr_ncl | (remaining != 0) ] = 0
     log.info("Removing lateral ventricles and eroded grey nuclei and brainstem from white matter mask")
     
     # ADD voxels from 'cc_unknown.nii.gz' dataset
     ccun = ni.load(op.join(fs_dir, 'label', 'cc_unknown.nii.gz'))
     ccund = ccun.get_data()
-    idx = np.where(ccund != 0)
     log.info("Add corpus callosum and unknown to wm mask")
-    wmmask[idx] = 1
+    wmmask[ccund != 0] = 1
     # XXX add unknown dilation for connecting corpus callosum?
 #    se2R = zeros(15,3,3); se2R(8:end,2,2)=1;
 #    se2L = zeros(15,3,3); se2L(1:8,2,2)=1;
@@ -304,31 +411,14 @@ def create_wm_mask():
 #    fsmask.img(cc_unknown.img==4)    =  1;
     
     # XXX: subtracting wmmask from ROI. necessary?
-    for parkey, parval in gconf.parcellation.items():
-        
-        # check if we should subtract the cortical rois from this parcellation
-        if parval.has_key('subtract_from_wm_mask'):
-            if not bool(int(parval['subtract_from_wm_mask'])):
-                continue
-        else:
-            continue
-
-        log.info("Loading %s to subtract cortical ROIs from white matter mask" % ('ROI_%s.nii.gz' % parkey) )
-        roi = ni.load(op.join(gconf.get_fs(), 'label', 'ROI_%s.nii.gz' % parkey))
-        roid = roi.get_data()
-        
-        assert roid.shape[0] == wmmask.shape[0]
-        
-        pg = nx.read_graphml(parval['node_information_graphml'])
-        
-        for brk, brv in pg.nodes_iter(data=True):
-            
-            if brv['dn_region'] == 'cortical':
-                
-                log.info("Subtracting region %s with intensity value %s" % (brv['dn_region'], brv['dn_correspondence_id']))
-    
-                idx = np.where(roid == int(brv['dn_correspondence_id']))
-                wmmask[idx] = 0
+    # check if we should subtract the cortical rois from this parcellation
+    scales = [parkey for parkey, parval in gconf.parcellation.items()
+              if parval.has_key('subtract_from_wm_mask') and bool(int(parval['subtract_from_wm_mask']))]
+    shared.clear()
+    shared['shape'] = wmmask.shape
+    for cortical in map_scales(cortical_mask_scale, scales):
+        wmmask[cortical] = 0
+    shared.clear()
     
     # output white matter mask. crop and move it afterwards
     wm_out = op.join(fs_dir, 'mri', 'fsmask_1mm.nii.gz')
@@ -336,6 +426,38 @@ def create_wm_mask():
     log.info("Save white matter mask: %s" % wm_out)
     ni.save(img, wm_out)
 
+def cortical_mask_scale(parkey):
+    """ Returns the mask of the cortical ROIs of the parcellation scale parkey,
+    subtracted from the white matter mask by create_wm_mask() """
+    parval = gconf.parcellation[parkey]
+
+    log.info("Loading %s to subtract cortical ROIs from white matter mask" % ('ROI_%s.nii.gz' % parkey) )
+    roi = ni.load(op.join(gconf.get_fs(), 'label', 'ROI_%s.nii.gz' % parkey))
+    roid = roi.get_data()
+    
+    assert roid.shape[0] == shared['shape'][0]
+    
+    pg = nx.read_graphml(parval['node_information_graphml'])
+    
+    # membership table of the cortical regions
+    cortical = [int(brv['dn_correspondence_id']) for brk, brv in pg.nodes_iter(data=True) if brv['dn_region'] == 'cortical']
+    log.info("Subtracting %i cortical regions" % len(cortical))
+    return relabel(roid, [ [[1, i] for i in cortical] ], dtype = np.bool_)[0]
+
+def crop_and_move(ds):
+    """ Reslice the datasets (from, to) to the original volume, several at once """
+    orig = op.join(gconf.get_fs(), 'mri', 'orig', '001.mgz')
+
+    cmds = []
+    for d in ds:
+        # does it exist at all?
+        if not op.exists(d[0]):
+            raise Exception('File %s does not exist.' % d[0])
+        # reslice to original volume because the roi creation with freesurfer
+        # changed to 256x256x256 resolution
+        cmds.append( 'mri_convert -rl "%s" -rt nearest "%s" -nc "%s"' % (orig, d[0], d[1]) )
+    runCmds( cmds, log, gconf.command_processes, fail_fast = False )
+
 def crop_and_move_datasets():
     
     fs_dir = gconf.get_fs()
@@ -355,18 +477,7 @@ def crop_and_move_datasets():
     for p in gconf.parcellation.keys():
         ds.append( (op.join(fs_dir, 'label', 'ROI_%s.nii.gz' % p), op.join(reg_path, p, 'ROI_HR_th.nii.gz')) )
     
-    orig = op.join(fs_dir, 'mri', 'orig', '001.mgz')
-        
-    for d in ds:
-        log.info("Processing %s:" % d[0])
-        
-        # does it exist at all?
-        if not op.exists(d[0]):
-            raise Exception('File %s does not exist.' % d[0])
-        # reslice to original volume because the roi creation with freesurfer
-        # changed to 256x256x256 resolution
-        mri_cmd = 'mri_convert -rl "%s" -rt nearest "%s" -nc "%s"' % (orig, d[0], d[1])
-        runCmd( mri_cmd,log )
+    crop_and_move(ds)
 
 
 def generate_WM_and_GM_mask():
@@ -416,12 +527,20 @@ def generate_WM_and_GM_mask():
     # 27  Left-Substancia-Nigra
     # 28  Left-VentralDC
     
+    # the GM mapping of each parcellation, the parcellations with the same
+    # mapping share their GM volume
+    GMMAPPING = dict( (park, MAPPING) for park in gconf.parcellation.keys() )
+    distinct = []
+    for park in sorted(GMMAPPING.keys()):
+        if not GMMAPPING[park] in distinct:
+            distinct.append(GMMAPPING[park])
+
+    # relabel the WM and the GM volumes at once
+    volumes = relabel(niiAPARCdata, [[[1, i] for i in WM]] + distinct)
+
     log.info("WM mask....")
     #%% create WM mask    
-    niiWM = np.zeros( niiAPARCdata.shape, dtype = np.uint8 )
-
-    for i in WM:
-         niiWM[niiAPARCdata == i] = 1
+    niiWM = volumes[0]
 
     # we do not add subcortical regions
 #    for i in SUBCORTICAL[1]:
@@ -438,10 +557,7 @@ def generate_WM_and_GM_mask():
         log.info("Parcellation: " + park)
         GMout = op.join(fs_dir, 'mri', 'ROI_%s.nii.gz' % park)
 
-        niiGM = np.zeros( niiAPARCdata.shape, dtype = np.uint8 )
-
-        for ma in MAPPING:
-            niiGM[ niiAPARCdata == ma[1]] = ma[0]
+        niiGM = volumes[1 + distinct.index(GMMAPPING[park])]
             
 #        # % 33 cortical regions (stored in the order of "parcel33")
 #        for idx,i in enumerate(CORTICAL[1]):
@@ -478,18 +594,7 @@ def crop_and_move_WM_and_GM():
     for p in gconf.parcellation.keys():
         ds.append( (op.join(fs_dir, 'mri', 'ROI_%s.nii.gz' % p), op.join(reg_path, p, 'ROI_HR_th.nii.gz')) )
     
-    orig = op.join(fs_dir, 'mri', 'orig', '001.mgz')
-        
-    for d in ds:
-        log.info("Processing %s:" % d[0])
-        
-        # does it exist at all?
-        if not op.exists(d[0]):
-            raise Exception('File %s does not exist.' % d[0])
-        # reslice to original volume because the roi creation with freesurfer
-        # changed to 256x256x256 resolution
-        mri_cmd = 'mri_convert -rl "%s" -rt nearest "%s" -nc "%s"' % (orig, d[0], d[1])
-        runCmd( mri_cmd,log )
+    crop_and_move(ds)
 
 def inspect(gconf):
     """ Inspect the results of this stage """
@@ -545,8 +650,10 @@ def run(conf):
     
     if gconf.parcellation_scheme == "Lausanne2008":
         create_annot_label()
-        create_roi()
-        create_wm_mask()
+        # aseg is loaded once for all scales and the white matter mask
+        aseg = ni.load(op.join(gconf.get_fs(), 'mri', 'aseg.nii.gz'))
+        create_roi(aseg)
+        create_wm_mask(aseg)
         crop_and_move_datasets()
     elif gconf.parcellation_scheme == "NativeFreesurfer":
         generate_WM_and_GM_mask()
@@ -558,6 +665,11 @@ def run(conf):
         msg = ["Mask creation", int(time()-start)]
         send_email_notification(msg, gconf, log)  
         
+def required_cpus(conf):
+    """ Number of cpus used by this stage: the parcellation scales processed
+    in parallel, or the external commands run at once """
+    return max(conf.parcellation_processes, conf.command_processes)
+
 def declare_inputs(conf):
     """Declare the inputs to the stage to the PipelineStatus object"""
     
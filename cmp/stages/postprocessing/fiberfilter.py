@@ -8,6 +8,7 @@ import os, os.path as op
 from time import time
 from ...logme import *
 import cmp.util as util
+import cmp.fiberstore as fiberstore
 import numpy as np
 import nibabel.trackvis as tv
     
@@ -31,18 +32,14 @@ def spline_filtering():
 def compute_length_array(trkfile=None, streams=None, savefname = 'lengths.npy'):
     if streams is None and not trkfile is None:
         log.info("Compute length array for fibers in %s" % trkfile)
-        streams, hdr = tv.read(trkfile, as_generator = True)
-        n_fibers = hdr['n_count']
+        streams = fiberstore.load_packed(trkfile, log = log)
+        n_fibers = len(streams)
         if n_fibers == 0:
-            msg = "Header field n_count of trackfile %s is set to 0. No track seem to exist in this file." % trkfile
+            msg = "No track seem to exist in trackfile %s." % trkfile
             log.error(msg)
             raise Exception(msg)
-    else:
-        n_fibers = len(streams)
         
-    leng = np.zeros(n_fibers, dtype = np.float)
-    for i,fib in enumerate(streams):
-        leng[i] = util.length(fib[0])
+    leng = streams.map_packed(util.length_packed)
     
     # store length array
     lefname = op.join(gconf.get_cmp_fibers(), savefname)
@@ -67,28 +64,49 @@ def filter_fibers(applied_spline=False):
     
     outtrk = op.join(gconf.get_cmp_fibers(), 'streamline_cutfiltered.trk')
     
-    # compute length array
-    le = compute_length_array(intrk, savefname = 'lengths_beforecutfiltered.npy')
+    # locate the fiber records, they are read once chunk by chunk
+    hdr = fiberstore.read_header(intrk)
+    (words, starts, counts) = fiberstore.scan_trackvis(intrk, hdr)
+    n_fibers = len(counts)
+    if n_fibers == 0:
+        msg = "No track seem to exist in trackfile %s." % intrk
+        log.error(msg)
+        raise Exception(msg)
     
-    # cut the fibers smaller than value
-    reducedidx = np.where((le>gconf.fiber_cutoff_lower) & (le<gconf.fiber_cutoff_upper))[0]
+    le = np.zeros(n_fibers, dtype = np.float)
+    keep = np.zeros(n_fibers, dtype = np.bool)
+    
+    log.info("Write out file: %s" % outtrk)
+    writer = fiberstore.TrackvisWriter(outtrk, intrk, hdr)
+    try:
+        for a in range(0, n_fibers, fiberstore.CHUNK_SIZE):
+            b = min(a + fiberstore.CHUNK_SIZE, n_fibers)
+            
+            # compute length array
+            points = fiberstore.read_points(words, starts[a:b], counts[a:b], hdr)
+            offsets = np.concatenate( ([0], np.cumsum(counts[a:b])) )
+            le[a:b] = util.length_packed(points, offsets)
+            
+            # cut the fibers smaller than value
+            keep[a:b] = (le[a:b]>gconf.fiber_cutoff_lower) & (le[a:b]<gconf.fiber_cutoff_upper)
+            
+            # copy the records of the remaining fibers
+            writer.copy(words, starts[a:b][keep[a:b]], counts[a:b][keep[a:b]])
+    finally:
+        writer.close()
     
-    # load trackfile (downside, needs everything in memory)
-    fibold, hdrold = tv.read(intrk)
+    log.info("Kept %i of %i fibers" % (writer.n, n_fibers))
     
-    # rewrite the track vis file with the reduced number of fibers
-    outstreams = []
-    for i in reducedidx:
-        outstreams.append( fibold[i] )
+    lefname = op.join(gconf.get_cmp_fibers(), 'lengths_beforecutfiltered.npy')
+    np.save(lefname, le)
+    log.info("Store lengths array to: %s" % lefname)
     
-    n_fib_out = len(outstreams)
-    hdrnew = hdrold.copy()
-    hdrnew['n_count'] = n_fib_out
+    lefname = op.join(gconf.get_cmp_fibers(), 'lengths.npy')
+    np.save(lefname, le[keep])
+    log.info("Store lengths array for cutted fibers to: %s" % lefname)
     
-    log.info("Compute length array for cutted fibers")
-    le = compute_length_array(streams=outstreams)
-    log.info("Write out file: %s" % outtrk)
-    tv.write(outtrk, outstreams, hdrnew)
+    # pack the fibers for the downstream stages
+    fiberstore.pack_trackvis(outtrk, log)
     
     # ----
     # extension idea
@@ -124,16 +142,25 @@ def run(conf):
         spline_filtering()
         if gconf.apply_fiberlength:
             filter_fibers(applied_spline=True)
+            # the cut filtered fibers are packed, the store of the spline
+            # filtered ones was only needed for their lengths
+            fiberstore.remove_packed(op.join(gconf.get_cmp_fibers(), 'streamline_splinefiltered.trk'), log)
             util.myrename(op.join(gconf.get_cmp_fibers(), 'streamline_cutfiltered.trk'),
-                          op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)            
+                          op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)
+            fiberstore.rename_packed(op.join(gconf.get_cmp_fibers(), 'streamline_cutfiltered.trk'),
+                                     op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)
         else:
             util.myrename(op.join(gconf.get_cmp_fibers(), 'streamline_splinefiltered.trk'),
                           op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)
+            fiberstore.rename_packed(op.join(gconf.get_cmp_fibers(), 'streamline_splinefiltered.trk'),
+                                     op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)
     else:
         if gconf.apply_fiberlength:
             filter_fibers(applied_spline=False)
             util.myrename(op.join(gconf.get_cmp_fibers(), 'streamline_cutfiltered.trk'),
-                          op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)    
+                          op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)
+            fiberstore.rename_packed(op.join(gconf.get_cmp_fibers(), 'streamline_cutfiltered.trk'),
+                                     op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk'), log)
             
     log.info("Module took %s seconds to process." % (time()-start))
     
@@ -156,6 +183,8 @@ def declare_outputs(conf):
     fibers_path = conf.get_cmp_fibers()
     
     conf.pipeline_status.AddStageOutput(stage, fibers_path, 'streamline_filtered.trk', 'streamline-trk')
+    conf.pipeline_status.AddStageOutput(stage, fibers_path, 'streamline_filtered_points.npy', 'streamline_filtered_points-npy')
+    conf.pipeline_status.AddStageOutput(stage, fibers_path, 'streamline_filtered_offsets.npy', 'streamline_filtered_offsets-npy')
     conf.pipeline_status.AddStageOutput(stage, conf.get_cmp_fibers(), 'lengths.npy', 'lengths-npy') 
                       
 
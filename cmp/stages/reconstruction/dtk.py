@@ -12,6 +12,91 @@ from glob import glob
 import subprocess
 from cmp.util import mymove
 import gzip
+import numpy as np
+import nibabel as ni
+
+def resampled_geometry(affine, shape, voxel_size):
+    """ Returns the affine and the shape of a volume resampled to voxel_size
+    as by mri_convert -vs: same orientation and center, the field of view
+    covered by ceil(extent / voxel_size) voxels """
+    shape = np.array(shape[:3], dtype = np.float64)
+    voxel_size = np.array(voxel_size, dtype = np.float64)
+    zooms = np.sqrt( (affine[:3,:3] ** 2).sum(axis = 0) )
+    # the rounding error of the extent must not add a voxel
+    newshape = np.ceil( np.round(shape * zooms / voxel_size, 6) ).astype(np.int32)
+    center = np.dot(affine[:3,:3], shape / 2.0) + affine[:3,3]
+    newaffine = np.eye(4)
+    newaffine[:3,:3] = affine[:3,:3] / zooms * voxel_size
+    newaffine[:3,3] = center - np.dot(newaffine[:3,:3], newshape / 2.0)
+    return newaffine, tuple(newshape)
+
+def axis_interpolation(n, scale, offset, m):
+    """ Returns the lower and upper source voxels and their weights for the m
+    voxels of an axis resampled from n voxels, the voxel i of the resampled
+    axis being at scale * i + offset. Voxels outside of the source get the
+    weight 0. """
+    x = scale * np.arange(m) + offset
+    inside = (x >= 0) & (x < n)
+    i0 = np.clip(np.floor(x).astype(np.int32), 0, n - 1)
+    i1 = np.minimum(i0 + 1, n - 1)
+    w1 = np.where(inside, x - np.floor(x), 0)
+    w0 = np.where(inside, 1 - w1, 0)
+    return i0, i1, w0, w1
+
+def resample_trilinear(vol, interpolation):
+    """ Trilinear resampling of the 3D volume vol, given the interpolation of
+    each axis. The resampled voxels are aligned with the source axes, the
+    interpolation is separable. """
+    out = vol.astype(np.float64)
+    for axis, (i0, i1, w0, w1) in enumerate(interpolation):
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        out = out.take(i0, axis = axis) * w0.reshape(shape) + out.take(i1, axis = axis) * w1.reshape(shape)
+    return out
+
+def resample_series(input_file, output_file, series_dir = None, voxel_size = (2, 2, 2)):
+    """ Resample the volumes of a 4D series to voxel_size with trilinear
+    interpolation as mri_convert -vs does, cast them to short and store the
+    merged series in output_file.
+
+    The volumes are resampled by gconf.command_processes threads. If
+    series_dir is given, each volume is also stored in series_dir as
+    MR0000.nii.gz, MR0001.nii.gz, ... as by fslsplit.
+    """
+    img = ni.load(input_file)
+    data = img.get_data()
+    if data.ndim == 3:
+        data = data.reshape( data.shape + (1,) )
+    affine = img.get_affine()
+    newaffine, newshape = resampled_geometry(affine, data.shape, voxel_size)
+
+    # the resampled voxels in the voxels of the input
+    T = np.dot(np.linalg.inv(affine), newaffine)
+    interpolation = [axis_interpolation(data.shape[i], T[i,i], T[i,3], newshape[i]) for i in range(3)]
+
+    hdr = img.get_header().copy()
+    hdr.set_data_dtype(np.int16)
+    hdr.set_slope_inter(1.0, 0.0)
+    nvol = data.shape[3]
+    out = np.zeros( newshape + (nvol,), dtype = np.int16 )
+    log.info("Resample %i volumes of %s to %s" % (nvol, input_file, 'x'.join([str(v) for v in voxel_size])))
+
+    def resample(t):
+        vol = resample_trilinear(data[..., t], interpolation)
+        out[..., t] = np.clip(np.rint(vol), -32768, 32767)
+        if not series_dir is None:
+            ni.save(ni.Nifti1Image(out[..., t], newaffine, hdr), op.join(series_dir, 'MR%04d.nii.gz' % t))
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(gconf.command_processes, nvol)))
+    try:
+        pool.map(resample, range(nvol))
+    finally:
+        pool.close()
+        pool.join()
+
+    log.info("Save resampled series: %s" % output_file)
+    ni.save(ni.Nifti1Image(out, newaffine, hdr), output_file)
 
 def resample_dsi():
 
@@ -19,7 +104,6 @@ def resample_dsi():
     log.info("======================================")
 
     input_dsi_file = op.join(gconf.get_nifti(), 'DSI.nii.gz')
-    # XXX: this output file is never generated!
     output_dsi_file = op.join(gconf.get_cmp_rawdiff(), 'DSI_resampled_2x2x2.nii.gz')
     res_dsi_dir = gconf.get_cmp_rawdiff_resampled()
     
@@ -28,19 +112,8 @@ def resample_dsi():
     else:
         log.debug("Found file: %s" % input_dsi_file)
             
-    split_cmd = 'fslsplit %s %s -t' % (input_dsi_file, op.join(res_dsi_dir, 'MR'))
-    runCmd( split_cmd, log )
-    
-    files = glob( op.join(res_dsi_dir, 'MR*.nii.gz'))
-    for file in sorted(files):        
-        tmp_file = op.join(res_dsi_dir, 'tmp.nii.gz')
-        mri_cmd = 'mri_convert -vs 2 2 2 %s %s ' % (file, tmp_file)
-        runCmd( mri_cmd, log )
-        fsl_cmd = 'fslmaths %s %s -odt short' % (tmp_file, file)
-        runCmd( fsl_cmd, log )        
-
-    fslmerge_cmd = 'fslmerge -a %s %s' % (output_dsi_file,  op.join(res_dsi_dir, 'MR0000.nii.gz'))
-    runCmd( fslmerge_cmd, log )
+    # odf_recon reads the resampled volumes starting at MR0000.nii.gz
+    resample_series(input_dsi_file, output_dsi_file, res_dsi_dir)
 
     log.info(" [DONE] ")
 
@@ -50,7 +123,6 @@ def resample_qball():
     log.info("======================================")
 
     input_dsi_file = op.join(gconf.get_nifti(), 'QBALL.nii.gz')
-    # XXX: this output file is never generated!
     output_dsi_file = op.join(gconf.get_cmp_rawdiff(), 'QBALL_resampled_2x2x2.nii.gz')
     res_dsi_dir = gconf.get_cmp_rawdiff_resampled()
 
@@ -59,19 +131,8 @@ def resample_qball():
     else:
         log.debug("Found file: %s" % input_dsi_file)
 
-    split_cmd = 'fslsplit %s %s -t' % (input_dsi_file, op.join(res_dsi_dir, 'MR'))
-    runCmd( split_cmd, log )
-
-    files = glob( op.join(res_dsi_dir, 'MR*.nii.gz'))
-    for file in sorted(files):
-        tmp_file = op.join(res_dsi_dir, 'tmp.nii.gz')
-        mri_cmd = 'mri_convert -vs 2 2 2 %s %s ' % (file, tmp_file)
-        runCmd( mri_cmd, log )
-        fsl_cmd = 'fslmaths %s %s -odt short' % (tmp_file, file)
-        runCmd( fsl_cmd, log )
-
-    fslmerge_cmd = 'fslmerge -a %s %s' % (output_dsi_file,  op.join(res_dsi_dir, 'MR0000.nii.gz'))
-    runCmd( fslmerge_cmd, log )
+    # odf_recon reads the resampled volumes starting at MR0000.nii.gz
+    resample_series(input_dsi_file, output_dsi_file, res_dsi_dir)
 
     log.info(" [DONE] ")
     
@@ -81,28 +142,14 @@ def resample_dti():
     log.info("======================================")
 
     input_dsi_file = op.join(gconf.get_nifti(), 'DTI.nii.gz')
-    # XXX: this output file is never generated!
     output_dsi_file = op.join(gconf.get_cmp_rawdiff(), 'DTI_resampled_2x2x2.nii.gz')
-    res_dsi_dir = gconf.get_cmp_rawdiff_resampled()
     
     if not op.exists(input_dsi_file):
         log.error("File does not exists: %s" % input_dsi_file)
     else:
         log.debug("Found file: %s" % input_dsi_file)
             
-    split_cmd = 'fslsplit %s %s -t' % (input_dsi_file, op.join(res_dsi_dir, 'MR'))
-    runCmd( split_cmd, log )
-    
-    files = glob( op.join(res_dsi_dir, 'MR*.nii.gz'))
-    for file in sorted(files):        
-        tmp_file = op.join(res_dsi_dir, 'tmp.nii.gz')
-        mri_cmd = 'mri_convert -vs 2 2 2 %s %s ' % (file, tmp_file)
-        runCmd( mri_cmd, log )
-        fsl_cmd = 'fslmaths %s %s -odt short' % (tmp_file, file)
-        runCmd( fsl_cmd, log )        
-    
-    fslmerge_cmd = 'fslmerge -a %s %s' % (output_dsi_file,  op.join(res_dsi_dir, 'MR*.nii.gz'))
-    runCmd( fslmerge_cmd, log )
+    resample_series(input_dsi_file, output_dsi_file)
 
     log.info(" [DONE] ")
     
@@ -419,6 +466,11 @@ def run(conf):
         msg = ["Diffusion module", int(time()-start)]
         send_email_notification(msg, gconf, log)
           
+def required_cpus(conf):
+    """ Number of cpus used by this stage: the external commands or the
+    resampling threads run at once """
+    return conf.command_processes
+
 def declare_inputs(conf):
     """Declare the inputs to the stage to the PipelineStatus object"""
     
@@ -12,6 +12,15 @@ from glob import glob
 import subprocess
 import shutil
 
+def check_warped_files(tracto_masks_path_out, warp_files):
+    """ Raise an exception if one of the warped files was not generated """
+    for infile in warp_files:
+        if not op.exists(op.join(tracto_masks_path_out, infile)):
+            msg = "An error occurred. File %s not generated." % op.join(tracto_masks_path_out, infile)
+            log.error(msg)
+            raise Exception(msg)
+    log.info("[ DONE ]")
+
 def apply_nlin_registration():
     
     log.info("Apply the nonlinear REGISTRATION TRANSFORM to the output of FreeSurfer (WM+GM)")
@@ -41,6 +50,7 @@ def apply_nlin_registration():
     for park in gconf.parcellation.keys():
         warp_files.append(op.join(park, 'ROI_HR_th.nii.gz'))
     
+    cmds = []
     for infile in warp_files:
         log.info("Warp file: %s" % infile)
         applywarp_cmp = 'applywarp --in="%s" --premat="%s" --ref="%s" --warp="%s" --out="%s" --interp=nn' % \
@@ -50,14 +60,11 @@ def apply_nlin_registration():
                          op.join(gconf.get_nifti(), 'T2-TO-b0_warp.nii.gz'),
                          op.join(tracto_masks_path_out, infile)
                          )
-        runCmd (applywarp_cmp, log )
-        
-        if not op.exists(op.join(tracto_masks_path_out, infile)):
-            msg = "An error occurred. File %s not generated." % op.join(tracto_masks_path_out, infile)
-            log.error(msg)
-            raise Exception(msg)
-        
-        log.info("[ DONE ]")
+        cmds.append( applywarp_cmp )
+
+    # the files are warped independently, several at once
+    runCmds( cmds, log, gconf.command_processes )
+    check_warped_files(tracto_masks_path_out, warp_files)
         
     log.info("Chain of registrations applied. [ DONE ]")
     log.info("[ Saved in %s ]" % tracto_masks_path_out)
@@ -92,6 +99,7 @@ def apply_lin_registration():
     for park in gconf.parcellation.keys():
         warp_files.append(op.join(park, 'ROI_HR_th.nii.gz'))
     
+    cmds = []
     for infile in warp_files:
         log.info("Warp file: %s" % infile)
         flirt_cmd = 'flirt -applyxfm -init %s -in %s -ref %s -out %s -interp nearestneighbour' % (
@@ -100,15 +108,11 @@ def apply_lin_registration():
                     op.join(gconf.get_nifti(), 'Diffusion_b0_resampled.nii.gz'),
                     op.join(tracto_masks_path_out, infile)
                     )
-        
-        runCmd( flirt_cmd, log )
-        
-        if not op.exists(op.join(tracto_masks_path_out, infile)):
-            msg = "An error occurred. File %s not generated." % op.join(tracto_masks_path_out, infile)
-            log.error(msg)
-            raise Exception(msg)
-        
-        log.info("[ DONE ]")              
+        cmds.append( flirt_cmd )
+
+    # the files are warped independently, several at once
+    runCmds( cmds, log, gconf.command_processes )
+    check_warped_files(tracto_masks_path_out, warp_files)
         
     log.info("Chain of registrations applied. [ DONE ]")
     log.info("[ Saved in %s ]" % tracto_masks_path_out)
@@ -140,6 +144,10 @@ def run(conf):
         send_email_notification(msg, gconf, log)  
         
         
+def required_cpus(conf):
+    """ Number of cpus used by this stage: the external commands run at once """
+    return conf.command_processes
+
 def declare_inputs(conf):
     """Declare the inputs to the stage to the PipelineStatus object"""
     
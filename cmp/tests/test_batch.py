@@ -0,0 +1,39 @@
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" Tests of the pipeline status of the subjects run by a batch """
+
+import os, os.path as op
+import shutil
+import tempfile
+
+from cmp.configuration import PipelineConfiguration
+from cmp.connectome import setup_pipeline_status
+
+def test_subjects_have_own_pipeline_status():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        subjects = []
+        for name in ['subj1', 'subj2']:
+            cobj = PipelineConfiguration()
+            cobj.project_dir = tmpdir
+            cobj.subject_name = name
+            cobj.subject_workingdir = op.join(tmpdir, name, 'tp1')
+            os.makedirs(cobj.subject_workingdir)
+            stages = setup_pipeline_status(cobj)
+            subjects.append( (cobj, stages) )
+
+        assert not subjects[0][0].pipeline_status is subjects[1][0].pipeline_status
+        for cobj, stages in subjects:
+            subj_dir = cobj.get_subj_dir()
+            # declaring the stages again does not add them twice
+            assert len(cobj.pipeline_status.Pipeline.stages) == len(stages)
+            stage = cobj.pipeline_status.GetStage('cmp.stages.connectionmatrix.creatematrix')
+            assert len(stage.inputs) > 0
+            for inp in stage.inputs:
+                assert inp.rootDir.startswith(subj_dir + op.sep), inp.rootDir
+    finally:
+        shutil.rmtree(tmpdir)
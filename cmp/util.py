@@ -10,7 +10,6 @@ import subprocess
 import numpy as np
 from logme import *
 from enthought.traits.api import HasStrictTraits, Str
-import networkx as nx
 
 try:
     from pylab import imshow, show, cm, figure
@@ -22,10 +21,15 @@ class KeyValue(HasStrictTraits):
     value = Str
 
 def show_matrix(a, edge, binarize = False):
+    """ Show the matrix of measure edge of the graph or SparseConnectome a """
     figure()
-    for u,v,d in a.edges_iter(data=True):
-        a.edge[u][v]['weight'] = a.edge[u][v][edge]
-    bb=nx.to_numpy_matrix(a)
+    if hasattr(a, 'dense'):
+        bb = a.dense(edge)
+    else:
+        import networkx as nx
+        for u,v,d in a.edges_iter(data=True):
+            a.edge[u][v]['weight'] = a.edge[u][v][edge]
+        bb=nx.to_numpy_matrix(a)
     if binarize:
         c=np.zeros(bb.shape)
         c[bb>0] = 1
@@ -137,6 +141,33 @@ def reorient(src, ref, log):
         os.remove(tmpsrc)
     log.info("Remove temporary file %s" % tmpsrc)   
 
+def label_centroids(labels):
+    """ Centroids of all labels of a label volume, computed in a single pass
+
+    Parameters
+    ----------
+    labels : array
+        volume of non-negative integer labels, 0 is the background
+
+    Returns
+    -------
+    centroids : array (labels.max()+1, labels.ndim)
+        the mean voxel coordinates of each label, nan for absent labels
+    """
+    labels = np.asarray(labels)
+    idx = np.nonzero(labels)
+    lab = labels[idx].astype(np.intp)
+    if len(lab) == 0:
+        return np.zeros( (1, labels.ndim) ) * np.nan
+    count = np.bincount(lab).astype(np.float64)
+    centroids = np.empty( (len(count), labels.ndim) )
+    centroids.fill(np.nan)
+    valid = count > 0
+    for d in range(labels.ndim):
+        s = np.bincount(lab, weights = idx[d])
+        centroids[valid, d] = s[valid] / count[valid]
+    return centroids
+
 def DTB_viewer():
     """ Run the DTB Viewer """
     #XXX
@@ -189,6 +220,99 @@ def length(xyz, along=False):
         return np.cumsum(dists)
     return np.sum(dists)
 
+def length_packed(points, offsets):
+    ''' Euclidean lengths of all tracks of a packed points array
+
+    Parameters
+    ----------
+    points : array-like shape (N,3)
+       the points of all tracks, one track after the other
+    offsets : array-like shape (n+1,)
+       the points of track i are points[offsets[i]:offsets[i+1]]
+
+    Returns
+    -------
+    L : array shape (n,)
+       the length of each track, as given by `length`
+
+    Examples
+    --------
+    >>> xyz = np.array([[1,1,1],[2,3,4],[0,0,0]])
+    >>> pts = np.concatenate((xyz, [[5,5,5]], xyz))
+    >>> L = length_packed(pts, [0, 3, 4, 7])
+    >>> np.allclose(L, [length(xyz), 0, length(xyz)])
+    True
+    '''
+    points = np.asarray(points)
+    offsets = np.asarray(offsets)
+    n = len(offsets) - 1
+    counts = np.diff(offsets)
+    L = np.zeros(n)
+    multi = counts >= 2
+    if not multi.any():
+        return L
+    # one diff over all points, the segments joining two tracks are masked
+    dists = np.sqrt((np.diff(points, axis=0)**2).sum(axis=1))
+    inner = offsets[1:-1]
+    inner = inner[(inner > 0) & (inner < len(points))]
+    dists[inner - 1] = 0
+    L[multi] = np.add.reduceat(dists, offsets[:-1][multi])
+    return L
+
+def resample_packed(points, offsets, n_pts):
+    ''' Resample all tracks of a packed points array to n_pts points
+    equidistant along each track
+
+    Parameters
+    ----------
+    points : array-like shape (N,3)
+       the points of all tracks, one track after the other
+    offsets : array-like shape (n+1,)
+       the points of track i are points[offsets[i]:offsets[i+1]]
+    n_pts : int
+       number of points of the resampled tracks, at least 2
+
+    Returns
+    -------
+    R : array shape (n, n_pts, 3)
+       the resampled tracks, the first and last points are kept. Tracks
+       with a single point are repeated.
+
+    Examples
+    --------
+    >>> pts = np.array([[0,0,0],[2,0,0],[2,4,0],[1,1,1]])
+    >>> R = resample_packed(pts, [0, 3, 4], 4)
+    >>> np.allclose(R[0], [[0,0,0],[2,0,0],[2,2,0],[2,4,0]])
+    True
+    >>> np.allclose(R[1], [1,1,1])
+    True
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets)
+    n = len(offsets) - 1
+    if n == 0:
+        return np.zeros((0, n_pts, 3))
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    # arc length of all points along the whole packed array, the segments
+    # joining two tracks have length 0
+    dists = np.sqrt((np.diff(points, axis=0)**2).sum(axis=1))
+    inner = offsets[1:-1]
+    inner = inner[(inner > 0) & (inner < len(points))]
+    dists[inner - 1] = 0
+    s = np.concatenate(([0.], np.cumsum(dists)))
+    # the arc length of the new points of all tracks
+    t = s[first][:,None] + (s[last] - s[first])[:,None] * np.linspace(0, 1, n_pts)
+    # the segment of each new point, kept inside its own track
+    k = np.searchsorted(s, t.ravel(), side='right').reshape(t.shape) - 1
+    k = np.minimum(np.maximum(k, first[:,None]), np.maximum(last - 1, first)[:,None])
+    k1 = np.minimum(k + 1, last[:,None])
+    ds = s[k1] - s[k]
+    f = (t - s[k]) / np.where(ds > 0, ds, 1)
+    f[ds <= 0] = 0
+    f = np.clip(f, 0, 1)[..., None]
+    return points[k] * (1 - f) + points[k1] * f
+
 def magn(xyz,n=1):
     ''' magnitude of vector
         
@@ -243,4 +367,56 @@ def mean_curvature(xyz):
     #Curvature
     k = magn(np.cross(dxyz,ddxyz),1)/(magn(dxyz,1)**3)    
         
-    return np.mean(k)
\ No newline at end of file
+    return np.mean(k)
+
+def _gradient_packed(x, offsets):
+    ''' Gradient along each track of a packed array, as np.gradient(xyz)[0]
+    computes it for a single track. Tracks need at least two points. '''
+    g = np.empty_like(x)
+    # central differences, the track ends are fixed below
+    g[1:-1] = (x[2:] - x[:-2]) / 2.
+    first = offsets[:-1]
+    last = offsets[1:] - 1
+    g[first] = x[first + 1] - x[first]
+    g[last] = x[last] - x[last - 1]
+    return g
+
+def mean_curvature_packed(points, offsets):
+    ''' Mean curvatures of all tracks of a packed points array
+
+    Parameters
+    ------------
+    points : array-like shape (N,3)
+       the points of all tracks, one track after the other
+    offsets : array-like shape (n+1,)
+       the points of track i are points[offsets[i]:offsets[i+1]]
+
+    Returns
+    -----------
+    m : array shape (n,)
+        the mean curvature of each track, as given by `mean_curvature`.
+        Tracks with less than two points have a mean curvature of 0.
+    '''
+    points = np.asarray(points)
+    offsets = np.asarray(offsets)
+    counts = np.diff(offsets)
+    m = np.zeros(len(counts))
+    multi = counts >= 2
+    if not multi.any():
+        return m
+
+    # keep the tracks with at least two points
+    if not multi.all():
+        rows = np.repeat(multi, counts)
+        points = points[rows]
+        offsets = np.concatenate( ([0], np.cumsum(counts[multi])) )
+        counts = counts[multi]
+
+    dxyz = _gradient_packed(points, offsets)
+    ddxyz = _gradient_packed(dxyz, offsets)
+
+    #Curvature
+    k = magn(np.cross(dxyz,ddxyz),1)/(magn(dxyz,1)**3)
+
+    m[multi] = np.add.reduceat(k[:,0], offsets[:-1]) / counts
+    return m
@@ -0,0 +1,131 @@
+# Copyright (C) 2009-2011, Ecole Polytechnique Federale de Lausanne (EPFL) and
+# Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" Connection matrices stored as compressed sparse matrix bundles.
+
+A bundle is a compressed .npz file holding the node ids, the row and column
+of each edge in the node order (row <= col), and one array with the value of
+each edge measure. Loading a bundle only reads the measures asked for, the
+NetworkX graph is built only when it is requested.
+"""
+
+import os.path as op
+import numpy as np
+import networkx as nx
+
+# the arrays of a bundle which are not edge measures
+_STRUCTURE = ['nodes', 'row', 'col']
+
+def save_sparse_connectome(fname, nodes, edges, measures):
+    """ Store the edge measures of a connectome as a sparse matrix bundle
+
+    Parameters
+    ----------
+    fname : string
+        the .npz file name
+    nodes : array (n,)
+        the node ids, in the order of the matrix rows and columns
+    edges : array (e, 2)
+        the node ids of each edge
+    measures : dict
+        the measure names and their arrays (e,) of edge values
+
+    """
+    nodes = np.asarray(nodes)
+    edges = np.asarray(edges)
+    order = np.argsort(nodes)
+    pos = order[np.searchsorted(nodes[order], edges.ravel())].reshape(edges.shape)
+    arrays = { 'nodes' : nodes,
+               'row' : pos.min(axis = 1).astype(np.int32),
+               'col' : pos.max(axis = 1).astype(np.int32) }
+    for k, v in measures.items():
+        if k in _STRUCTURE:
+            raise ValueError('Invalid measure name %s' % k)
+        arrays[k] = np.asarray(v)
+    np.savez_compressed(fname, **arrays)
+
+class SparseConnectome(object):
+    """ A connectome loaded from a sparse matrix bundle
+
+    Parameters
+    ----------
+    fname : string
+        the .npz file name
+    gpickle : string, optional
+        the NetworkX graph stored with the bundle, returned by graph()
+        instead of building a graph from the edge measures
+
+    """
+
+    def __init__(self, fname, gpickle = None):
+        self.fname = fname
+        self.gpickle = gpickle
+        self._npz = np.load(fname)
+        self.nodes = self._npz['nodes']
+        self.row = self._npz['row']
+        self.col = self._npz['col']
+        self.measures = sorted([k for k in self._npz.files if not k in _STRUCTURE])
+        self._values = {}
+        self._graph = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def values(self, measure):
+        """ Returns the array of the values of measure for each edge """
+        if not measure in self._values:
+            self._values[measure] = self._npz[measure]
+        return self._values[measure]
+
+    def matrix(self, measure, format = 'csr'):
+        """ Returns the symmetric scipy.sparse matrix of measure in the given
+        format, indexed by the positions of the node ids in nodes """
+        import scipy.sparse as sparse
+        val = self.values(measure)
+        offdiag = self.row != self.col
+        row = np.concatenate( (self.row, self.col[offdiag]) )
+        col = np.concatenate( (self.col, self.row[offdiag]) )
+        val = np.concatenate( (val, val[offdiag]) )
+        n = len(self.nodes)
+        return sparse.coo_matrix( (val, (row, col)), shape = (n, n) ).asformat(format)
+
+    def dense(self, measure):
+        """ Returns the symmetric matrix of measure as an array """
+        n = len(self.nodes)
+        val = self.values(measure)
+        a = np.zeros( (n, n), dtype = val.dtype )
+        a[self.row, self.col] = val
+        a[self.col, self.row] = val
+        return a
+
+    def graph(self):
+        """ Returns the connectome as NetworkX graph, built on the first call """
+        if self._graph is None:
+            if not self.gpickle is None and op.exists(self.gpickle):
+                self._graph = nx.read_gpickle(self.gpickle)
+            else:
+                G = nx.Graph()
+                G.add_nodes_from([int(u) for u in self.nodes])
+                for k in self.measures:
+                    self.values(k)
+                for e in range(len(self.row)):
+                    di = {}
+                    for k in self.measures:
+                        di[k] = self._values[k][e].item()
+                    G.add_edge(int(self.nodes[self.row[e]]), int(self.nodes[self.col[e]]), di)
+                self._graph = G
+        return self._graph
+
+def load_sparse_connectome(fname):
+    """ Load a sparse matrix bundle, the graph is read from the gpickle of the
+    same name if it is requested and exists """
+    base = fname[:-len('_matrices.npz')] if fname.endswith('_matrices.npz') else op.splitext(fname)[0]
+    return SparseConnectome(fname, gpickle = base + '.gpickle')
+
+def load_matrices(fnames, measure, format = 'csr'):
+    """ Returns the sparse matrices of measure of many bundles, e.g. of all
+    subjects of a group, reading only this measure of each bundle """
+    return [SparseConnectome(f).matrix(measure, format) for f in fnames]
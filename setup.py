@@ -20,7 +20,9 @@ packages=["cmp",
           "cmp.stages.tractography",
           "cmp.stages.stats",
           "cmp.stages.template_module",
-          "cmp.pipeline"]
+          "cmp.utility",
+          "cmp.pipeline",
+          "cmp.tests"]
 
 package_data = {'cmp':
                 ['data/colortable_and_gcs/*.txt',